@@ -0,0 +1,1028 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+"""
+Analysis of rolls without rolling them
+
+moments works out the mean, variance, minimum and maximum of a roll. Every
+dice group is summarised in closed form from the faces of its die, so the
+cost does not depend on the number of dice, and since groups are independent
+of each other their summaries combine exactly through +, - and *. Keeping or
+dropping dice is worked out from order statistics where that stays cheap, and
+estimated from seeded samples of how many dice land on each face otherwise.
+Operators and functions that are not linear are estimated from a bounded
+number of successful samples. Estimated results are marked as inexact.
+
+Dice are described as segments (low, high, weight): every integer from low to
+high inclusive comes up with probability weight. What a die adds to its group
+is described as pieces (low, high, slope, offset): a die showing a face in
+[low, high] adds slope * face + offset.
+"""
+
+import ast
+import functools
+import itertools
+import math
+import operator
+import random
+
+from .rolldice import (DEFAULT_FUNCTIONS, DEFAULT_OPS, DEFAULT_OPS_NO_FLOAT, MAX_POWER, DiceDiagnostic,
+                       DiceOperatorException, SimpleEval, _parse_roll, check_roll, safe_power)
+
+
+INF = math.inf
+TAIL_EPSILON = 1e-12  # Probability below which explosion chains are no longer followed
+EXACT_KEEP_LIMIT = 200000  # Rough number of steps above which keep/drop is estimated instead of worked out exactly
+ESTIMATION_SAMPLES = 2000  # Samples used to estimate operators and functions that are not linear
+ESTIMATION_ATTEMPTS = 20000  # Largest number of samples drawn to get that many that do not fail
+KEEP_ESTIMATION_SAMPLES = 5000  # Samples of large keep/drop groups, the variance is within a few percent
+ESTIMATION_SEED = 0
+DIRECT_SAMPLE_LIMIT = 64  # Groups with more dice are sampled from a normal approximation instead of rolled
+OUTCOME_LIMIT = 4096  # Largest number of distinct results outcomes works out
+COMBINATION_LIMIT = 2 ** 20  # Largest number of combinations of results outcomes tries for one node
+
+
+class Moments:
+    def __init__(self, mean, variance, minimum, maximum, exact=True):
+        """
+        Summary of the distribution of a roll
+
+        :param mean: Expected value
+        :param variance: Variance
+        :param minimum: Smallest possible value, -inf if there is none. Only a lower bound when not exact
+        :param maximum: Largest possible value, inf if there is none. Only an upper bound when not exact
+        :param exact: Whether the moments are exact rather than estimated
+        """
+        self.mean = mean
+        self.variance = variance
+        self.minimum = minimum
+        self.maximum = maximum
+        self.exact = exact
+
+    @classmethod
+    def constant(cls, value):
+        return cls(value, 0, value, value)
+
+    @property
+    def std(self):
+        """
+        :return: Standard deviation
+        """
+        return math.sqrt(self.variance)
+
+    def __add__(self, other):
+        return Moments(self.mean + other.mean, self.variance + other.variance, self.minimum + other.minimum,
+                       self.maximum + other.maximum, self.exact and other.exact)
+
+    def __neg__(self):
+        return Moments(-self.mean, self.variance, -self.maximum, -self.minimum, self.exact)
+
+    def __pos__(self):
+        return self
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __mul__(self, other):
+        """
+        Product of two independent rolls
+        """
+        mean = self.mean * other.mean
+        variance = (self.variance + self.mean ** 2) * (other.variance + other.mean ** 2) - mean ** 2
+        corners = [_product(a, b) for a in (self.minimum, self.maximum) for b in (other.minimum, other.maximum)]
+        return Moments(mean, max(variance, 0), min(corners), max(corners), self.exact and other.exact)
+
+    def __truediv__(self, divisor):
+        """
+        Roll divided by a constant
+        """
+        bounds = (self.minimum / divisor, self.maximum / divisor)
+        return Moments(self.mean / divisor, self.variance / divisor ** 2, min(bounds), max(bounds), self.exact)
+
+    def __eq__(self, other):
+        return isinstance(other, Moments) and (self.mean, self.variance, self.minimum, self.maximum, self.exact) == \
+            (other.mean, other.variance, other.minimum, other.maximum, other.exact)
+
+    def __repr__(self):
+        return 'Moments(mean=%r, variance=%r, minimum=%r, maximum=%r, exact=%r)' % (
+            self.mean, self.variance, self.minimum, self.maximum, self.exact)
+
+
+def _product(a, b):
+    """
+    Product of two bounds, where zero times infinity is zero
+    """
+    return 0 if a == 0 or b == 0 else a * b
+
+
+def _square_sum(n):
+    """
+    :return: Sum of x ** 2 for x from 1 to n, extended to every integer so that differences work for negative ranges
+    """
+    return n * (n + 1) * (2 * n + 1) // 6
+
+
+def _segments(die):
+    """
+    :param die: Die
+    :return: Segments of a single roll of the die
+    """
+    if isinstance(die.values, range):
+        return [(die.min, die.max, 1 / (die.max - die.min + 1))]
+    counts = {}
+    for face in die.faces:
+        counts[face] = counts.get(face, 0) + 1
+    return [(face, face, count / len(die.faces)) for face, count in sorted(counts.items())]
+
+
+def _intervals(comparison, comparator, negate=False):
+    """
+    :param comparison: '<', '>' or '=' for a specific number
+    :param comparator: Value to compare to
+    :param negate: Whether to describe the values failing the comparison instead
+    :return: List of (low, high) intervals of the integers passing the comparison
+    """
+    if comparison == '<':
+        return [(comparator, INF)] if negate else [(-INF, comparator - 1)]
+    elif comparison == '>':
+        return [(-INF, comparator)] if negate else [(comparator + 1, INF)]
+    return [(-INF, comparator - 1), (comparator + 1, INF)] if negate else [(comparator, comparator)]
+
+
+def _restrict(segments, intervals):
+    """
+    :return: Segments restricted to a list of intervals
+    """
+    return [(max(low, a), min(high, b), weight) for low, high, weight in segments for a, b in intervals
+            if max(low, a) <= min(high, b)]
+
+
+def _shift(segments, shift):
+    return [(low + shift, high + shift, weight) for low, high, weight in segments]
+
+
+def _scale(segments, factor):
+    return [(low, high, weight * factor) for low, high, weight in segments]
+
+
+def _mass(segments):
+    """
+    :return: Total probability of some segments
+    """
+    return sum((high - low + 1) * weight for low, high, weight in segments)
+
+
+def _expect(segments, pieces):
+    """
+    Partial first and second moment of what a die adds, over some segments
+
+    :return: Sum of g(x) * P(x) and of g(x) ** 2 * P(x)
+    """
+    first = second = 0
+    for low, high, weight in segments:
+        for a, b, slope, offset in pieces:
+            a, b = max(low, a), min(high, b)
+            if a > b:
+                continue
+            n = b - a + 1
+            s1 = (a + b) * n // 2
+            s2 = _square_sum(b) - _square_sum(a - 1)
+            first += weight * (slope * s1 + offset * n)
+            second += weight * (slope * slope * s2 + 2 * slope * offset * s1 + offset * offset * n)
+    return first, second
+
+
+def _extremes(segments, pieces):
+    """
+    :return: Smallest and largest thing a die can add over some segments, (inf, -inf) if there are none
+    """
+    values = []
+    for low, high, weight in segments:
+        for a, b, slope, offset in pieces:
+            a, b = max(low, a), min(high, b)
+            if a <= b:
+                values += [slope * a + offset, slope * b + offset]
+    return (min(values), max(values)) if values else (INF, -INF)
+
+
+def _evaluate(pieces, x):
+    """
+    :return: What a die showing x adds
+    """
+    for low, high, slope, offset in pieces:
+        if low <= x <= high:
+            return slope * x + offset
+    raise ValueError('%r is not covered by the pieces' % x)
+
+
+def _pieces(group):
+    """
+    What a die adds to its group as a function of its face, after penetration: the individual modifier, or the
+    score of the die when counting successes and failures
+
+    :param group: DiceGroup
+    :return: Pieces covering every integer
+    """
+    slope, offset = 1, 0
+    if group.individual is not None:
+        modifier, number = group.individual
+        slope, offset = {'a': (1, number), 's': (1, -number), 'm': (number, 0)}[modifier]
+    if group.success is None:
+        return [(-INF, INF, slope, offset)]
+
+    def score(x):
+        value = slope * x + offset
+        if group.success_test(value):
+            return 1
+        return -1 if group.failure_test is not None and group.failure_test(value) else 0
+
+    starts = set()  # First face of each piece with a different score
+    if slope:
+        for comparison, comparator in filter(None, (group.success, group.failure)):
+            starts.add((comparator - offset) // slope + 1 if comparison == '>' else -((offset - comparator) // slope))
+    bounds = [-INF] + sorted(starts) + [INF]
+
+    pieces = []
+    for low, high in zip(bounds, bounds[1:]):
+        high = high - 1 if high != INF else high
+        representative = low if low != -INF else (high if high != INF else 0)
+        pieces.append((low, high, 0, score(representative)))
+    return pieces
+
+
+def _reroll_segments(group):
+    """
+    :return: Segments of a die of the group once it has been rerolled
+    """
+    segments = _segments(group.die)
+    if group.reroll is None:
+        return segments
+    comparison, comparator, once = group.reroll
+    kept = _restrict(segments, _intervals(comparison, comparator, negate=True))
+    rerolled = _mass(_restrict(segments, _intervals(comparison, comparator)))
+    if once:
+        return kept + _scale(segments, rerolled)
+    return _scale(kept, 1 / (1 - rerolled))
+
+
+def _die_moments(group):
+    """
+    Mean, second moment and range of what one die of a group adds, along with everything it explodes into.
+    A chain of explosions T is g(X) + [X explodes] T', where every later die T' = g(X - p) + [X explodes] T'
+    and p is 1 for penetrating dice, which solves to closed forms for the first two moments.
+
+    :param group: DiceGroup without keep/drop
+    :return: Mean, second moment, minimum and maximum
+    """
+    segments = _reroll_segments(group)
+    pieces = _pieces(group)
+    mean, second = _expect(segments, pieces)
+    low, high = _extremes(segments, pieces)
+    if group.explode is None:
+        return mean, second, low, high
+
+    comparison, comparator, penetrate = group.explode
+    exploding = _restrict(segments, _intervals(comparison, comparator))
+    stopping = _restrict(segments, _intervals(comparison, comparator, negate=True))
+    chance = _mass(exploding)
+    if not exploding:
+        return mean, second, low, high
+    shift = -1 if penetrate else 0
+
+    later_mean, later_second = _expect(_shift(segments, shift), pieces)
+    chain_mean = later_mean / (1 - chance)
+    chain_second = (later_second + 2 * _expect(_shift(exploding, shift), pieces)[0] * chain_mean) / (1 - chance)
+    mean = mean + chance * chain_mean
+    second = second + 2 * _expect(exploding, pieces)[0] * chain_mean + chance * chain_second
+
+    stop_low, stop_high = _extremes(stopping, pieces)
+    explode_low, explode_high = _extremes(exploding, pieces)
+    later_stop_low, later_stop_high = _extremes(_shift(stopping, shift), pieces)
+    later_explode_low, later_explode_high = _extremes(_shift(exploding, shift), pieces)
+    chain_low = later_stop_low if later_explode_low >= 0 else -INF  # Each explosion that takes away makes it unbounded
+    chain_high = later_stop_high if later_explode_high <= 0 else INF
+    return mean, second, min(stop_low, explode_low + chain_low), max(stop_high, explode_high + chain_high)
+
+
+def _binomial(n, k, p):
+    """
+    :return: Probability of exactly k successes out of n tries with probability p
+    """
+    if p <= 0:
+        return 1.0 if k == 0 else 0.0
+    if p >= 1:
+        return 1.0 if k == n else 0.0
+    return math.exp(math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1) +
+                    k * math.log(p) + (n - k) * math.log1p(-p))
+
+
+def _probabilities(segments):
+    """
+    :return: Dict of the probability of every face of some segments
+    """
+    probabilities = {}
+    for low, high, weight in segments:
+        for face in range(low, high + 1):
+            probabilities[face] = probabilities.get(face, 0) + weight
+    return probabilities
+
+
+def _keep_exact(segments, pieces, num_of_dice, kept, highest):
+    """
+    Moments of the kept dice, going through the faces from the kept end. After j dice have been placed on the
+    faces seen so far, min(j, kept) of them are kept, so only j needs tracking, along with the partial moments
+    of the kept sum.
+
+    :return: Mean and variance
+    """
+    probabilities = _probabilities(segments)
+    states = {0: (1.0, 0.0, 0.0)}  # Dice placed: probability, partial first and second moment of the kept sum
+    remaining = 1.0  # Probability of the faces not seen yet
+    for face in sorted(probabilities, reverse=highest):
+        p = min(probabilities[face] / remaining, 1) if remaining > 0 else 1
+        remaining -= probabilities[face]
+        value = _evaluate(pieces, face)
+        next_states = {}
+        for placed, (probability, first, second) in states.items():
+            if placed == kept:
+                outcomes = [(0, 1.0)]
+            else:
+                outcomes = [(count, _binomial(num_of_dice - placed, count, p)) for count in range(kept - placed)]
+                outcomes.append((kept - placed, max(1 - sum(q for count, q in outcomes), 0)))
+            for count, q in outcomes:
+                if q == 0:
+                    continue
+                added = count * value
+                total = next_states.get(placed + count, (0.0, 0.0, 0.0))
+                next_states[placed + count] = (total[0] + q * probability, total[1] + q * (first + added * probability),
+                                               total[2] + q * (second + 2 * added * first + added * added * probability))
+        states = next_states
+
+    probability, first, second = states[kept]
+    return first, max(second - first * first, 0)
+
+
+def _keep_exploding_exact(segments, pieces, group, kept, highest):
+    """
+    Moments of the kept dice of an exploding group, where explosions can be kept like any other die. Rolls the
+    dice one after the other, tracking only the dice that would be kept so far.
+
+    :return: Mean, variance, minimum and maximum
+    """
+    probabilities = _probabilities(segments)
+    shift = -1 if group.explode[2] else 0
+    states = {(): 1.0}  # Values kept so far
+    for i in range(group.num_of_dice):
+        pending = states
+        states = {}
+        level_shift = 0
+        while pending:  # Roll one more die on every chain that is still exploding
+            next_pending = {}
+            for held, p in pending.items():
+                for face, q in probabilities.items():
+                    new = tuple(sorted(held + (face + level_shift,), reverse=highest)[:kept])
+                    target = next_pending if group.explode_test(face) else states
+                    target[new] = target.get(new, 0) + p * q
+            pending = {held: p for held, p in next_pending.items() if p > TAIL_EPSILON}
+            level_shift = shift
+
+    totals = {}
+    for held, p in states.items():
+        total = sum(_evaluate(pieces, value) for value in held)
+        totals[total] = totals.get(total, 0) + p
+    mass = sum(totals.values())
+    mean = sum(total * p for total, p in totals.items()) / mass
+    variance = sum((total - mean) ** 2 * p for total, p in totals.items()) / mass
+    return mean, variance, min(totals), max(totals)
+
+
+def _binomial_sample(n, p, generator):
+    """
+    Draws the number of successes out of n tries with probability p, in time that does not grow with n: by
+    skipping between successes when few are expected and by transformed rejection otherwise (Hormann, 1993)
+
+    :param generator: random.Random to draw from
+    :return: Number of successes
+    """
+    if n <= 0 or p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    if p > 0.5:
+        return n - _binomial_sample(n, 1 - p, generator)
+    if n * p < 10:
+        log_miss = math.log1p(-p)
+        successes = position = 0
+        while True:  # Tries up to and including the next success are geometric
+            position += int(math.log(1 - generator.random()) / log_miss) + 1
+            if position > n:
+                return successes
+            successes += 1
+
+    std = math.sqrt(n * p * (1 - p))
+    b = 1.15 + 2.53 * std
+    a = -0.0873 + 0.0248 * b + 0.01 * p
+    c = n * p + 0.5
+    squeeze = 0.92 - 4.2 / b
+    alpha = (2.83 + 5.1 / b) * std
+    log_odds = math.log(p / (1 - p))
+    mode = math.floor((n + 1) * p)
+    h = math.lgamma(mode + 1) + math.lgamma(n - mode + 1)
+    while True:
+        u = generator.random() - 0.5
+        us = 0.5 - abs(u)
+        k = math.floor((2 * a / us + b) * u + c)
+        if k < 0 or k > n:
+            continue
+        v = generator.random()
+        if us >= 0.07 and v <= squeeze:
+            return k
+        v *= alpha / (a / (us * us) + b)
+        if v > 0 and math.log(v) <= h - math.lgamma(k + 1) - math.lgamma(n - k + 1) + (k - mode) * log_odds:
+            return k
+
+
+def _uniform_sum(low, high, count, generator):
+    """
+    Draws the sum of count dice uniform over [low, high], from a normal approximation for many dice
+
+    :return: Sum
+    """
+    if count <= 32:
+        return sum(generator.randint(low, high) for i in range(count))
+    mean = count * (low + high) / 2
+    std = math.sqrt(count * ((high - low + 1) ** 2 - 1) / 12)
+    return min(max(round(generator.gauss(mean, std)), count * low), count * high)
+
+
+def _uniform_extreme_sum(low, high, count, taken, highest, generator):
+    """
+    Draws the sum of the taken highest or lowest of count dice uniform over [low, high], splitting the range in
+    halves until the kept end is found
+
+    :return: Sum
+    """
+    if low == high:
+        return taken * low
+    if count <= 32:
+        return sum(sorted((generator.randint(low, high) for i in range(count)), reverse=highest)[:taken])
+    middle = (low + high) // 2
+    near, far = ((middle + 1, high), (low, middle)) if highest else ((low, middle), (middle + 1, high))
+    near_count = _binomial_sample(count, (near[1] - near[0] + 1) / (high - low + 1), generator)
+    if near_count >= taken:
+        return _uniform_extreme_sum(near[0], near[1], near_count, taken, highest, generator)
+    return _uniform_sum(near[0], near[1], near_count, generator) + \
+        _uniform_extreme_sum(far[0], far[1], count - near_count, taken - near_count, highest, generator)
+
+
+def _split(blocks, cuts, generator):
+    """
+    Splits blocks of dice, uniform over each block, at cut points
+
+    :param blocks: Dict of (low, high) to number of dice
+    :param cuts: Sorted values at which a new block starts
+    :return: Dict of disjoint (low, high) to number of dice
+    """
+    split = {}
+    for (low, high), count in blocks.items():
+        starts = [low] + [cut for cut in cuts if low < cut <= high]
+        for start, end in zip(starts, starts[1:] + [high + 1]):
+            part = count if end > high else _binomial_sample(count, (end - start) / (high - start + 1), generator)
+            split[(start, end - 1)] = split.get((start, end - 1), 0) + part
+            count -= part
+    return split
+
+
+def _keep_sample(levels, pieces, num_of_dice, kept, highest, generator):
+    """
+    Draws the kept sum of a large group. Dice are counted per block of faces with one binomial draw per block and
+    explosion level, and only the block where the kept dice end is looked into.
+
+    :param levels: Blocks (low, high, probability, explodes) of the original dice and of explosions, from _keep_blocks
+    :return: Kept sum
+    """
+    blocks = {}  # Number of dice in each block of values, explosions included
+    pending = num_of_dice
+    first = True
+    while pending:
+        left, mass = pending, 1.0
+        pending = 0
+        for low, high, probability, explodes in levels[0 if first else 1]:
+            count = _binomial_sample(left, probability / mass if mass > 0 else 1, generator)
+            left -= count
+            mass -= probability
+            if count:
+                blocks[(low, high)] = blocks.get((low, high), 0) + count
+                pending += count if explodes else 0
+            if not left:
+                break
+        first = False
+
+    cuts = sorted({low for low, high in blocks} | {high + 1 for low, high in blocks} |
+                  {low for low, high, slope, offset in pieces if low != -INF})
+    total = 0
+    remaining = kept
+    for (low, high), count in sorted(_split(blocks, cuts, generator).items(), reverse=highest):
+        slope, offset = next((slope, offset) for a, b, slope, offset in pieces if a <= low <= b)
+        taken = min(count, remaining)
+        if taken == count:
+            total += slope * _uniform_sum(low, high, count, generator) + offset * count
+        else:
+            total += slope * _uniform_extreme_sum(low, high, count, taken, highest, generator) + offset * taken
+        remaining -= taken
+        if not remaining:
+            break
+    return total
+
+
+def _keep_blocks(segments, group):
+    """
+    :return: Blocks (low, high, probability, explodes) of the values of an original die and of an explosion
+    """
+    def blocks(segments, explodes):
+        return [(low, high, weight * (high - low + 1), explodes) for low, high, weight in segments]
+
+    if group.explode is None:
+        original = blocks(segments, False)
+        return original, original
+    comparison, comparator, penetrate = group.explode
+    original = sorted(blocks(_restrict(segments, _intervals(comparison, comparator)), True) +
+                      blocks(_restrict(segments, _intervals(comparison, comparator, negate=True)), False))
+    shift = -1 if penetrate else 0
+    return original, [(low + shift, high + shift, probability, explodes)
+                      for low, high, probability, explodes in original]
+
+
+def _keep_estimate(segments, pieces, group, kept, highest):
+    """
+    Estimates the moments of the kept dice of a large group from a fixed number of seeded samples. The relative
+    error of the variance is about sqrt(2 / KEEP_ESTIMATION_SAMPLES) for sums close to normal, more for skewed ones.
+
+    :return: Mean and variance
+    """
+    generator = random.Random(ESTIMATION_SEED)
+    levels = _keep_blocks(segments, group)
+    samples = [_keep_sample(levels, pieces, group.num_of_dice, kept, highest, generator)
+               for i in range(KEEP_ESTIMATION_SAMPLES)]
+    mean = math.fsum(samples) / len(samples)
+    return mean, math.fsum((x - mean) ** 2 for x in samples) / (len(samples) - 1)
+
+
+def _keep_moments(group):
+    """
+    :param group: DiceGroup with keep/drop
+    :return: Moments
+    """
+    mode, number = group.keep
+    num_of_dice = group.num_of_dice
+    kept = number if mode in 'Kk' else num_of_dice - number
+    highest = mode in 'Kx'
+    segments = _reroll_segments(group)
+    pieces = _pieces(group)
+
+    pool = segments
+    if group.explode is not None:  # Penetrating explosions can show one less than any face
+        pool = segments + _shift(segments, -1 if group.explode[2] else 0)
+
+    low, high = _extremes(pool, pieces)
+    faces = sum(high - low + 1 for low, high, weight in segments)
+    if group.explode is None and faces * kept ** 2 <= EXACT_KEEP_LIMIT:
+        mean, variance = _keep_exact(segments, pieces, num_of_dice, kept, highest)
+        return Moments(mean, variance, kept * low, kept * high)
+    values = faces * (2 if group.explode is not None and group.explode[2] else 1)
+    if group.explode is not None and math.comb(values + kept, kept) * values * num_of_dice <= EXACT_KEEP_LIMIT:
+        return Moments(*_keep_exploding_exact(segments, pieces, group, kept, highest))
+    mean, variance = _keep_estimate(segments, pieces, group, kept, highest)
+    return Moments(mean, variance, kept * low, kept * high, exact=False)
+
+
+@functools.lru_cache(maxsize=1024)
+def group_moments(group):
+    """
+    Moments of a single dice group, in time independent of the number of dice
+
+    :param group: DiceGroup
+    :return: Moments
+    """
+    if group.keep is not None:
+        return _keep_moments(group)
+    mean, second, low, high = _die_moments(group)
+    num_of_dice = group.num_of_dice
+    return Moments(num_of_dice * mean, num_of_dice * max(second - mean * mean, 0), num_of_dice * low,
+                   num_of_dice * high)
+
+
+def _corners(func, left, right):
+    """
+    :return: Smallest and largest value of func over the corners of two intervals
+    """
+    values = [func(a, b) for a in left for b in right]
+    return min(values), max(values)
+
+
+def _quotient(a, b):
+    if math.isinf(a) and math.isinf(b):
+        return INF if (a > 0) == (b > 0) else -INF
+    return a / b
+
+
+def _floor(x):
+    return x if math.isinf(x) else math.floor(x)
+
+
+def _magnitude(low, high):
+    """
+    :return: Smallest and largest absolute value over an interval
+    """
+    return (0 if low <= 0 <= high else min(abs(low), abs(high))), max(abs(low), abs(high))
+
+
+def _union(intervals):
+    """
+    :return: Smallest interval containing a list of intervals, (-inf, inf) if the list is empty
+    """
+    if not intervals:
+        return -INF, INF
+    return min(low for low, high in intervals), max(high for low, high in intervals)
+
+
+def _nonzero(low, high, real):
+    """
+    Parts of a divisor interval a roll can go on with, leaving out zero for integer divisors
+
+    :return: List of intervals, empty when there is no telling
+    """
+    if not low <= 0 <= high:
+        return [(low, high)]
+    if real:
+        return []
+    return [part for part in ((low, -1), (1, high)) if part[0] <= part[1]]
+
+
+def _interval(node, groups, floats, risks=None):
+    """
+    Range of values a node takes when the roll succeeds, and whether it can be a float. The range is exact for
+    dice groups, constants, +, - and *, since every group is independent, and contains every possible value
+    otherwise.
+
+    :param node: AST node of a parsed roll
+    :param groups: DiceGroups of the roll
+    :param floats: Whether floats are allowed
+    :param risks: List collecting (node, reason) for every operation that can fail, or None
+    :return: (minimum, maximum, whether the value can be a float)
+    """
+    def risk(reason):
+        if risks is not None:
+            risks.append((node, reason))
+
+    if isinstance(node, ast.Constant):
+        value = node.value if floats else int(node.value)
+        return value, value, isinstance(value, float)
+    if isinstance(node, ast.Name):
+        moments = group_moments(groups[int(node.id[2:])])
+        return moments.minimum, moments.maximum, False
+    if isinstance(node, ast.UnaryOp):
+        low, high, real = _interval(node.operand, groups, floats, risks)
+        return (-high, -low, real) if isinstance(node.op, ast.USub) else (low, high, real)
+
+    if isinstance(node, ast.BinOp):
+        left_low, left_high, left_real = _interval(node.left, groups, floats, risks)
+        right_low, right_high, right_real = _interval(node.right, groups, floats, risks)
+        left, right = (left_low, left_high), (right_low, right_high)
+        real = left_real or right_real
+        func = (DEFAULT_OPS if floats else DEFAULT_OPS_NO_FLOAT)[type(node.op)]
+
+        if func is operator.add:
+            return left_low + right_low, left_high + right_high, real
+        elif func is operator.sub:
+            return left_low - right_high, left_high - right_low, real
+        elif func is operator.mul:
+            return _corners(_product, left, right) + (real,)
+
+        elif func in (operator.truediv, operator.floordiv, operator.mod):
+            if right == (0, 0):
+                risk('divisor is always zero')
+            elif right_low <= 0 <= right_high:
+                risk('divisor can be zero')
+            divisors = _nonzero(right_low, right_high, right_real)
+            if func is operator.mod:  # The result takes the sign of the divisor and is smaller than it
+                step = 0 if real else 1
+                parts = []
+                for low, high in divisors:
+                    if low > 0:
+                        parts.append((0, high - step if left_low < 0 else min(high - step, left_high)))
+                    else:
+                        parts.append((low + step if left_high > 0 else max(low + step, left_low), 0))
+                return _union(parts) + (real,)
+            low, high = _union([_corners(_quotient, left, divisor) for divisor in divisors])
+            if func is operator.floordiv:
+                return _floor(low), _floor(high), real
+            return low, high, True
+
+        elif func is safe_power:
+            left_magnitude, right_magnitude = _magnitude(*left), _magnitude(*right)
+            for name, (smallest, largest) in (('base', left_magnitude), ('exponent', right_magnitude)):
+                if smallest > MAX_POWER:
+                    risk('%s is always larger than %d' % (name, MAX_POWER))
+                elif largest > MAX_POWER:
+                    risk('%s can be larger than %d' % (name, MAX_POWER))
+            if left_low <= 0 <= left_high and right_low < 0:
+                risk('zero can be raised to a negative power')
+
+            left = max(left_low, -MAX_POWER), min(left_high, MAX_POWER)  # safe_power refuses anything larger
+            right = max(right_low, -MAX_POWER), min(right_high, MAX_POWER)
+            if left[0] > left[1] or right[0] > right[1]:
+                return -INF, INF, real
+            if left[0] >= 0 and right[0] >= 0:
+                return _corners(operator.pow, left, right) + (real,)
+            if right[0] >= 0 and not right_real:  # Integer powers of a negative base alternate in sign
+                largest = max(_magnitude(*left)[1] ** right[1], _magnitude(*left)[1] ** right[0])
+                return -largest, largest, real
+            return -INF, INF, True
+        return -INF, INF, real
+
+    name = node.func.id
+    args = [_interval(arg, groups, floats, risks) for arg in node.args]
+    real = any(arg[2] for arg in args)
+    if name == 'abs':
+        low, high = _magnitude(*args[0][:2])
+        return low, high, real
+    elif name in ('floor', 'ceil'):
+        func = math.floor if name == 'floor' else math.ceil
+        return tuple(x if math.isinf(x) else func(x) for x in args[0][:2]) + (False,)
+    elif name in ('max', 'min'):
+        func = max if name == 'max' else min
+        return func(arg[0] for arg in args), func(arg[1] for arg in args), real
+    elif name == 'prime':
+        if args[0][2] and args[0][1] >= 2:
+            risk('prime can be given a float')
+        return 0, 1, False
+    elif name == 'gcd':
+        return min(args[0][0], 0), max(args[0][1], args[1][1], 0), real
+    elif name == 'lcm':  # lcm(a, b) divides by gcd(a, b), which is a whenever b is not positive
+        if args[0][0] <= 0 <= args[0][1] and args[1][0] <= 0:
+            risk('lcm can divide by zero')
+        bound = _magnitude(*args[0][:2])[1] * _magnitude(*args[1][:2])[1]
+        return (0 if args[0][0] >= 0 and args[1][0] > 0 else -bound), bound, True
+    return -INF, INF, real
+
+
+def _source(node, locations, roll):
+    """
+    Finds the text of a node in the roll
+
+    :param node: AST node of a parsed roll
+    :param locations: Locations of the tokens, from _parse_roll
+    :param roll: Roll in dice notation
+    :return: Text and position of the node
+    """
+    start = max((location for location in locations if location[0] <= node.col_offset), default=(0, '', 0))[2]
+    end = min((location[2] for location in locations if location[0] >= node.end_col_offset), default=len(roll))
+    return roll[start:end].strip(), start
+
+
+@functools.lru_cache(maxsize=1024)
+def _static(roll, functions, floats):
+    """
+    Cached implementation of bounds and risks
+
+    :return: Minimum, maximum, whether the result can be a float and a tuple of DiceDiagnostic
+    """
+    fragments, groups, tree, locations = _parse_roll(roll, floats)
+    risks = []
+    low, high, real = _interval(tree, groups, floats, risks)
+    return low, high, real and floats, tuple(DiceDiagnostic(*_source(node, locations, roll), reason) for node, reason in risks)
+
+
+def bounds(roll, *, functions=True, floats=True):
+    """
+    Works out the smallest and largest result of a roll without rolling it. Bounds are exact for dice, +, - and *
+    and safe otherwise: every successful roll lies within them.
+
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: Tuple of minimum and maximum, which are infinite where the roll is unbounded
+    """
+    check_roll(roll, functions=functions, floats=floats)
+    return _static(roll, functions, floats)[:2]
+
+
+def risks(roll, *, functions=True, floats=True):
+    """
+    Finds the operations of a roll that can fail when it is rolled, ie. a division by a group that can be zero or
+    an exponent that can be larger than safe_power allows. A roll without risks never fails.
+
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: List of DiceDiagnostic with the failing subexpression, its position and the reason
+    """
+    check_roll(roll, functions=functions, floats=floats)
+    return list(_static(roll, functions, floats)[3])
+
+
+def _sumset(values, count):
+    """
+    :return: Set of sums of count values, each taken from values, or None if it grows too large
+    """
+    sums = {0}
+    for i in range(count):
+        if len(sums) * len(values) > COMBINATION_LIMIT:
+            return None
+        sums = {a + b for a in sums for b in values}
+        if len(sums) > OUTCOME_LIMIT:
+            return None
+    return sums
+
+
+def _group_outcomes(group):
+    """
+    :return: Set of values a dice group can take, or None if there are too many of them
+    """
+    if group.explode is not None or len(group.die.values) > OUTCOME_LIMIT:  # Explosions have no upper bound
+        return None
+    values = group.die.values
+    if group.reroll is not None and not group.reroll[2]:  # Faces rerolled until they stop matching never show
+        values = [x for x in values if not group.reroll_test(x)]
+    if group.individual is not None:
+        operator, number = group.individual
+        values = [x + number if operator == 'a' else (x - number if operator == 's' else x * number) for x in values]
+    if group.success is not None:
+        failure = group.failure_test
+        values = {1 if group.success_test(x) else (-1 if failure is not None and failure(x) else 0) for x in values}
+
+    count = group.num_of_dice
+    if group.keep is not None:  # Every combination of kept values can come up, with the dropped dice below them
+        mode, number = group.keep
+        count = number if mode in 'Kk' else count - number
+    return _sumset(set(values), count)
+
+
+def _outcomes_of(node, groups, floats):
+    """
+    Every value a node takes when it succeeds
+
+    :return: Set of values, or None if there are too many of them
+    """
+    if isinstance(node, ast.Constant):
+        return {node.value if floats else int(node.value)}
+    if isinstance(node, ast.Name):
+        return _group_outcomes(groups[int(node.id[2:])])
+
+    operators = DEFAULT_OPS if floats else DEFAULT_OPS_NO_FLOAT
+    if isinstance(node, ast.UnaryOp):
+        func = operators[type(node.op)]
+        args = [node.operand]
+    elif isinstance(node, ast.BinOp):
+        func = operators[type(node.op)]
+        args = [node.left, node.right]
+    else:
+        func = DEFAULT_FUNCTIONS[node.func.id]
+        args = node.args
+
+    sets = []
+    size = 1
+    for arg in args:
+        values = _outcomes_of(arg, groups, floats)
+        if values is None:
+            return None
+        size *= len(values)
+        if size > COMBINATION_LIMIT:
+            return None
+        sets.append(values)
+
+    results = set()
+    for combination in itertools.product(*sets):
+        try:
+            value = func(*combination)
+        except Exception:  # Combinations that fail are not results
+            continue
+        results.add(int(value) if isinstance(value, bool) else value)
+        if len(results) > OUTCOME_LIMIT:
+            return None
+    return results
+
+
+@functools.lru_cache(maxsize=1024)
+def _outcomes(roll, functions, floats):
+    fragments, groups, tree, locations = _parse_roll(roll, floats)
+    results = _outcomes_of(tree, groups, floats)
+    if results is None:
+        return None
+    return tuple(sorted(results if floats else {int(x) for x in results}))
+
+
+def outcomes(roll, *, functions=True, floats=True):
+    """
+    Works out every result a roll can have without rolling it, when there are few enough of them
+
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: Sorted list of results, or None when the roll has more than OUTCOME_LIMIT results or no upper bound
+    """
+    check_roll(roll, functions=functions, floats=floats)
+    results = _outcomes(roll, functions, floats)
+    return None if results is None else list(results)
+
+
+def _group_sampler(group):
+    """
+    :return: Function drawing a value of a dice group, from a normal approximation for large groups
+    """
+    if group.num_of_dice <= DIRECT_SAMPLE_LIMIT:
+        return lambda: group.roll().value
+    moments = group_moments(group)
+    return lambda: min(max(round(random.gauss(moments.mean, moments.std)), moments.minimum), moments.maximum)
+
+
+def _estimate(node, groups, functions, floats):
+    """
+    Estimates the moments of a node from a fixed number of seeded samples, leaving out samples that fail to
+    evaluate so the moments are those of successful rolls. The global random state is restored afterwards.
+
+    :return: Inexact Moments
+    """
+    names = sorted({child.id for child in ast.walk(node) if isinstance(child, ast.Name) and child.id.startswith('_g')})
+    samplers = [(name, _group_sampler(groups[int(name[2:])])) for name in names]
+    evaluator = SimpleEval(functions=functions, floats=floats)
+
+    samples = []
+    state = random.getstate()
+    random.seed(ESTIMATION_SEED)
+    try:
+        for i in range(ESTIMATION_ATTEMPTS):
+            try:
+                samples.append(evaluator.eval_node(node, {name: sample() for name, sample in samplers}))
+            except Exception:
+                continue
+            if len(samples) == ESTIMATION_SAMPLES:
+                break
+    finally:
+        random.setstate(state)
+    if not samples:
+        raise DiceOperatorException('Error parsing operators and or functions')
+
+    mean = math.fsum(samples) / len(samples)
+    variance = math.fsum((x - mean) ** 2 for x in samples) / max(len(samples) - 1, 1)
+    low, high, real = _interval(node, groups, floats)
+    return Moments(mean, variance, low, high, exact=False)
+
+
+def _constant(node, functions, floats):
+    """
+    :return: Value of a node without dice groups, or None if it has groups or fails to evaluate
+    """
+    if any(isinstance(child, ast.Name) for child in ast.walk(node)):
+        return None
+    try:
+        return SimpleEval(functions=functions, floats=floats).eval_node(node)
+    except Exception:
+        return None
+
+
+def _analyse(node, groups, functions, floats):
+    """
+    Moments of a node, composing exactly through +, -, * and division by a constant, and estimating anything else
+
+    :return: Moments
+    """
+    if isinstance(node, ast.Constant):
+        return Moments.constant(node.value if floats else int(node.value))
+    if isinstance(node, ast.Name):
+        return group_moments(groups[int(node.id[2:])])
+    if isinstance(node, ast.UnaryOp):
+        operand = _analyse(node.operand, groups, functions, floats)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult)):
+        left = _analyse(node.left, groups, functions, floats)
+        right = _analyse(node.right, groups, functions, floats)
+        if isinstance(node.op, ast.Add):
+            return left + right
+        return left - right if isinstance(node.op, ast.Sub) else left * right
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div) and floats:  # Without floats / is floor division
+        divisor = _constant(node.right, functions, floats)
+        if divisor:
+            return _analyse(node.left, groups, functions, floats) / divisor
+    return _estimate(node, groups, functions, floats)
+
+
+@functools.lru_cache(maxsize=1024)
+def _moments(roll, functions, floats):
+    fragments, groups, tree, locations = _parse_roll(roll, floats)
+    return _analyse(tree, groups, functions, floats)
+
+
+def moments(roll, *, functions=True, floats=True):
+    """
+    Works out the mean, variance, minimum and maximum of a roll without rolling it
+
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: Moments. Minimum and maximum are infinite where the roll is unbounded, ie. for exploding dice
+    :raises DiceOperatorException: When an estimated part of the roll never evaluated, ie. a division by zero
+    """
+    check_roll(roll, functions=functions, floats=floats)
+    return _moments(roll, functions, floats)
@@ -0,0 +1,598 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+"""
+Statistical conformance harness for the dice roller
+
+Every sampling path has to produce exactly the same distribution as the
+reference roller. The harness keeps a corpus of expressions covering every
+modifier, each paired with an exact distribution built independently of the
+parser, samples every registered implementation with a fixed seed and runs a
+chi-square and a Kolmogorov-Smirnov test against the exact distribution.
+
+The number of samples of each roll is chosen so the chi-square test catches a
+distortion of effect size MIN_EFFECT (Cohen's w) with probability POWER, at a
+significance level that keeps the chance of any false failure in a whole run
+below FAMILY_ALPHA. A self-test checks that samplers with known bugs fail.
+
+Run it with:
+    python -m rolldice.conformance
+"""
+
+import itertools
+import math
+import random
+import sys
+
+from .rolldice import compile_roll, roll_dice
+
+
+TAIL_EPSILON = 1e-12  # Probability mass below which exploding chains are truncated
+DEFAULT_SEED = 1337
+FAMILY_ALPHA = 1e-3  # Chance of any correct sampler failing in a whole run, split over the checks (Bonferroni)
+MIN_EFFECT = 0.1  # Smallest distortion to catch, as Cohen's w = sqrt(sum((p1 - p0) ** 2 / p0))
+POWER = 0.99  # Chance of catching a distortion of MIN_EFFECT
+MAX_SAMPLES = 200000
+MAX_ENUMERATION = 200000  # Largest number of outcomes enumerated for keep/drop
+
+
+def uniform(faces):
+    """
+    Distribution of a single die
+
+    :param faces: Iterable of faces, repeated faces are weighted accordingly
+    :return: Dict mapping value to probability
+    """
+    faces = list(faces)
+    dist = {}
+    for face in faces:
+        dist[face] = dist.get(face, 0) + 1 / len(faces)
+    return dist
+
+
+def standard(sides):
+    """
+    Distribution of a single die with faces 1..sides
+
+    :param sides: Number of sides
+    :return: Dict mapping value to probability
+    """
+    return uniform(range(1, sides + 1))
+
+
+def convolve(a, b):
+    """
+    Distribution of the sum of two independent variables
+
+    :param a: Distribution A
+    :param b: Distribution B
+    :return: Distribution of A + B
+    """
+    result = {}
+    for x, p in a.items():
+        for y, q in b.items():
+            result[x + y] = result.get(x + y, 0) + p * q
+    return result
+
+
+def repeat(dist, n):
+    """
+    Distribution of the sum of n independent copies of a variable
+
+    :param dist: Distribution to sum
+    :param n: Number of copies
+    :return: Distribution of the sum
+    """
+    result = {0: 1.0}
+    for i in range(n):
+        result = convolve(result, dist)
+    return result
+
+
+def transform(dist, func):
+    """
+    Distribution of func(X)
+
+    :param dist: Distribution of X
+    :param func: Function to apply to every value
+    :return: Transformed distribution
+    """
+    result = {}
+    for x, p in dist.items():
+        result[func(x)] = result.get(func(x), 0) + p
+    return result
+
+
+def explode(die, condition, penetrate=False, score=None):
+    """
+    Distribution of a single exploding or penetrating die
+
+    :param die: Distribution of a single roll
+    :param condition: Function returning whether a roll explodes
+    :param penetrate: Whether rolls after the first get a -1 modifier
+    :param score: Function turning the value of each die into what it adds to the total, ie. 1 for a success
+    :return: Distribution of the total of the die and all its explosions
+    """
+    result = {}
+    pending = {0: 1.0}  # Running totals of chains that are still exploding
+    penalty = 0
+    while pending:
+        next_pending = {}
+        for total, p in pending.items():
+            for face, q in die.items():
+                value = total + (face - penalty if score is None else score(face - penalty))
+                if condition(face):
+                    next_pending[value] = next_pending.get(value, 0) + p * q
+                else:
+                    result[value] = result.get(value, 0) + p * q
+        pending = {x: p for x, p in next_pending.items() if p > TAIL_EPSILON}
+        penalty = 1 if penetrate else 0
+    return result
+
+
+def reroll(die, condition, once=False):
+    """
+    Distribution of a single die rerolled on a condition
+
+    :param die: Distribution of a single roll
+    :param condition: Function returning whether a roll is rerolled
+    :param once: Whether to reroll only once instead of until the condition fails
+    :return: Distribution of the final roll
+    """
+    rerolled = sum(p for x, p in die.items() if condition(x))
+    if once:
+        return {x: (0 if condition(x) else p) + rerolled * p for x, p in die.items()}
+    return {x: p / (1 - rerolled) for x, p in die.items() if not condition(x)}
+
+
+def count(die, success, failure=None):
+    """
+    Distribution of the score of a single die when counting successes and failures
+
+    :param die: Distribution of a single roll
+    :param success: Function returning whether a roll is a success
+    :param failure: Function returning whether a roll is a failure
+    :return: Distribution over -1, 0 and 1
+    """
+    return transform(die, lambda x: 1 if success(x) else (-1 if failure is not None and failure(x) else 0))
+
+
+def keep(die, n, keep_count, highest=True):
+    """
+    Distribution of the sum of the highest or lowest dice of a group, by enumeration
+
+    :param die: Distribution of a single roll
+    :param n: Number of dice rolled
+    :param keep_count: Number of dice kept
+    :param highest: Whether to keep the highest dice instead of the lowest
+    :return: Distribution of the sum of the kept dice
+    """
+    if len(die) ** n > MAX_ENUMERATION:
+        raise ValueError('Too many outcomes to enumerate')
+    result = {}
+    for outcome in itertools.product(die.items(), repeat=n):
+        values = sorted((x for x, p in outcome), reverse=highest)
+        p = math.prod(p for x, p in outcome)
+        total = sum(values[:keep_count])
+        result[total] = result.get(total, 0) + p
+    return result
+
+
+def keep_exploding(die, n, keep_count, condition, highest=True):
+    """
+    Distribution of the sum of the highest or lowest dice of an exploding group, explosions being kept like any
+    other die. Only the dice that would be kept so far are tracked, so nothing has to be enumerated.
+
+    :param die: Distribution of a single roll
+    :param n: Number of dice rolled before explosions
+    :param keep_count: Number of dice kept
+    :param condition: Function returning whether a roll explodes
+    :param highest: Whether to keep the highest dice instead of the lowest
+    :return: Distribution of the sum of the kept dice
+    """
+    states = {(): 1.0}  # Dice kept so far
+    for i in range(n):
+        pending = states  # Every state rolls the next die of the group
+        states = {}
+        while pending:
+            next_pending = {}
+            for kept, p in pending.items():
+                for face, q in die.items():
+                    new = tuple(sorted(kept + (face,), reverse=highest)[:keep_count])
+                    target = next_pending if condition(face) else states
+                    target[new] = target.get(new, 0) + p * q
+            pending = {kept: p for kept, p in next_pending.items() if p > TAIL_EPSILON}
+
+    result = {}
+    for kept, p in states.items():
+        result[sum(kept)] = result.get(sum(kept), 0) + p
+    return result
+
+
+CORPUS = [
+    ('3d6', repeat(standard(6), 3)),
+    ('2d6 + 3', transform(repeat(standard(6), 2), lambda x: x + 3)),
+    ('d20 - d4', convolve(standard(20), transform(standard(4), lambda x: -x))),
+    ('2d4 * 3', transform(repeat(standard(4), 2), lambda x: x * 3)),
+    ('3d6!', repeat(explode(standard(6), lambda x: x == 6), 3)),
+    ('2d10!9', repeat(explode(standard(10), lambda x: x == 9), 2)),
+    ('2d6!>4', repeat(explode(standard(6), lambda x: x > 4), 2)),
+    ('2d8!<3', repeat(explode(standard(8), lambda x: x < 3), 2)),
+    ('3d6!p', repeat(explode(standard(6), lambda x: x == 6, True), 3)),
+    ('d6!p', explode(standard(6), lambda x: x == 6, True)),
+    ('2d6!p5', repeat(explode(standard(6), lambda x: x == 5, True), 2)),
+    ('2d6!p>4', repeat(explode(standard(6), lambda x: x > 4, True), 2)),
+    ('4d6R', repeat(reroll(standard(6), lambda x: x == 1), 4)),
+    ('4d6r', repeat(reroll(standard(6), lambda x: x == 1, True), 4)),
+    ('3d8R8', repeat(reroll(standard(8), lambda x: x == 8), 3)),
+    ('3d8r<3', repeat(reroll(standard(8), lambda x: x < 3, True), 3)),
+    ('3d8R>5', repeat(reroll(standard(8), lambda x: x > 5), 3)),
+    ('4d6K3', keep(standard(6), 4, 3)),
+    ('4d6k2', keep(standard(6), 4, 2, highest=False)),
+    ('5d6X2', keep(standard(6), 5, 3, highest=False)),
+    ('5d6x', keep(standard(6), 5, 4)),
+    ('2d20K', keep(standard(20), 2, 1)),
+    ('10d10>6', repeat(count(standard(10), lambda x: x > 6), 10)),
+    ('8d6<3', repeat(count(standard(6), lambda x: x < 3), 8)),
+    ('10d10>6f<3', repeat(count(standard(10), lambda x: x > 6, lambda x: x < 3), 10)),
+    ('6d12<4f>10', repeat(count(standard(12), lambda x: x < 4, lambda x: x > 10), 6)),
+    ('3d6a2', repeat(transform(standard(6), lambda x: x + 2), 3)),
+    ('3d6s1', repeat(transform(standard(6), lambda x: x - 1), 3)),
+    ('2d6m3', repeat(transform(standard(6), lambda x: x * 3), 2)),
+    ('4dF', repeat(uniform((-1, 0, 1)), 4)),
+    ('4dF + 2', transform(repeat(uniform((-1, 0, 1)), 4), lambda x: x + 2)),
+    ('3d{0,0,1,1,2,3}', repeat(uniform((0, 0, 1, 1, 2, 3)), 3)),
+    ('d{-2,-1,0,5}a3', transform(uniform((-2, -1, 0, 5)), lambda x: x + 3)),
+    ('3d{1,1,2,3,5,8}K2', keep(uniform((1, 1, 2, 3, 5, 8)), 3, 2)),
+    ('5dF>0f<0', repeat(count(uniform((-1, 0, 1)), lambda x: x > 0, lambda x: x < 0), 5)),
+    ('2d{1,2,3}!', repeat(explode(uniform((1, 2, 3)), lambda x: x == 3), 2)),
+    ('2d{2,4,6}!p', repeat(explode(uniform((2, 4, 6)), lambda x: x == 6, True), 2)),
+    ('4d{0,1,2}R0', repeat(reroll(uniform((0, 1, 2)), lambda x: x == 0), 4)),
+    ('4dFr', repeat(reroll(uniform((-1, 0, 1)), lambda x: x == -1, True), 4)),
+    ('4d6r1K3', keep(reroll(standard(6), lambda x: x == 1, True), 4, 3)),
+    ('4d6a1K3', keep(transform(standard(6), lambda x: x + 1), 4, 3)),
+    ('6d6a1>4', repeat(count(transform(standard(6), lambda x: x + 1), lambda x: x > 4), 6)),
+    ('4d6!K3', keep_exploding(standard(6), 4, 3, lambda x: x == 6)),
+    ('3d8!k2', keep_exploding(standard(8), 3, 2, lambda x: x == 8, highest=False)),
+    ('10d10!>8>7', repeat(explode(standard(10), lambda x: x > 8, score=lambda x: int(x > 7)), 10)),
+    ('5d6!p6>5f<2', repeat(explode(standard(6), lambda x: x == 6, True, lambda x: 1 if x > 5 else -int(x < 2)), 5)),
+    ('3d6r1!', repeat(explode(reroll(standard(6), lambda x: x == 1, True), lambda x: x == 6), 3)),
+    ('2d6R<3!p', repeat(explode(reroll(standard(6), lambda x: x < 3), lambda x: x == 6, True), 2)),
+    ('4dF!a1>1', repeat(explode(uniform((-1, 0, 1)), lambda x: x == 1, score=lambda x: int(x + 1 > 1)), 4)),
+]
+
+
+def _sample_roll_dice(roll):
+    return roll_dice(roll)[0]
+
+
+def _sample_compiled(roll):
+    return compile_roll(roll)()
+
+
+SAMPLERS = {'roll_dice': _sample_roll_dice, 'compiled': _sample_compiled}
+
+
+def chi_square_sf(x, dof):
+    """
+    Survival function of the chi-square distribution
+
+    :param x: Chi-square statistic
+    :param dof: Degrees of freedom
+    :return: Probability of a statistic at least this large
+    """
+    if x <= 0:
+        return 1.0
+    a = dof / 2
+    x = x / 2
+    log_prefix = a * math.log(x) - x - math.lgamma(a)
+    if x < a + 1:  # Series for the lower incomplete gamma function
+        term = total = 1 / a
+        n = a
+        while abs(term) > abs(total) * 1e-15:
+            n += 1
+            term *= x / n
+            total += term
+        return max(0.0, 1 - total * math.exp(log_prefix))
+
+    # Continued fraction for the upper incomplete gamma function (modified Lentz)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return math.exp(log_prefix) * h
+
+
+def kolmogorov_sf(d, n):
+    """
+    Asymptotic survival function of the Kolmogorov-Smirnov statistic.
+    Conservative when the reference distribution is discrete.
+
+    :param d: KS statistic
+    :param n: Number of samples
+    :return: Probability of a statistic at least this large
+    """
+    t = (math.sqrt(n) + 0.12 + 0.11 / math.sqrt(n)) * d
+    if t < 0.2:
+        return 1.0
+    total = 0
+    for k in range(1, 101):
+        total += (-1) ** (k - 1) * math.exp(-2 * k * k * t * t)
+    return min(1.0, max(0.0, 2 * total))
+
+
+def chi_square_quantile(alpha, dof):
+    """
+    Inverse of chi_square_sf, by bisection
+
+    :param alpha: Probability of a statistic at least this large
+    :param dof: Degrees of freedom
+    :return: Critical value of the chi-square distribution
+    """
+    low, high = 0.0, dof + 10.0
+    while chi_square_sf(high, dof) > alpha:
+        high *= 2
+    for i in range(100):
+        middle = (low + high) / 2
+        if chi_square_sf(middle, dof) > alpha:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def noncentral_chi_square_sf(x, dof, noncentrality):
+    """
+    Survival function of the noncentral chi-square distribution, from Patnaik's scaled chi-square approximation
+
+    :param x: Chi-square statistic
+    :param dof: Degrees of freedom
+    :param noncentrality: Noncentrality parameter
+    :return: Probability of a statistic at least this large
+    """
+    scale = (dof + 2 * noncentrality) / (dof + noncentrality)
+    return chi_square_sf(x / scale, (dof + noncentrality) ** 2 / (dof + 2 * noncentrality))
+
+
+def _bins(dist, n):
+    """
+    Bins of the chi-square test: values in order, merged until each bin expects at least 5 of n samples
+
+    :return: List of lists of values
+    """
+    bins = []
+    current = []
+    expected = 0
+    for x in sorted(dist):
+        current.append(x)
+        expected += dist[x] * n
+        if expected >= 5:
+            bins.append(current)
+            current = []
+            expected = 0
+    if bins:  # Fold whatever is left into the last bin
+        bins[-1] += current
+    return bins
+
+
+def required_samples(dist, alpha, effect=MIN_EFFECT, power=POWER):
+    """
+    Smallest number of samples for which the chi-square test catches a distortion of a distribution with the
+    given effect size at least as often as the given power
+
+    :param dist: Exact distribution
+    :param alpha: Significance level of the test
+    :param effect: Effect size, Cohen's w
+    :param power: Probability of catching the distortion
+    :return: Number of samples, at most MAX_SAMPLES
+    """
+    n = 100
+    while n < MAX_SAMPLES:
+        dof = max(len(_bins(dist, n)) - 1, 1)
+        if noncentral_chi_square_sf(chi_square_quantile(alpha, dof), dof, n * effect ** 2) >= power:
+            return n
+        n = int(n * 1.1) + 1
+    return MAX_SAMPLES
+
+
+def chi_square_test(samples, dist):
+    """
+    Pearson chi-square goodness of fit test. Bins with an expected count below 5 are merged with their neighbours.
+
+    :param samples: List of sampled values
+    :param dist: Exact distribution
+    :return: Statistic, degrees of freedom and p-value
+    """
+    n = len(samples)
+    observed = {}
+    for x in samples:
+        observed[x] = observed.get(x, 0) + 1
+
+    unexpected = sum(c for x, c in observed.items() if x not in dist)
+    if unexpected:  # A value that can never happen fails outright
+        return math.inf, 0, 0.0
+
+    bins = [(sum(observed.get(x, 0) for x in values), sum(dist[x] for x in values) * n) for values in _bins(dist, n)]
+
+    if len(bins) < 2:
+        return 0.0, 0, 1.0
+
+    statistic = sum((o - e) ** 2 / e for o, e in bins)
+    dof = len(bins) - 1
+    return statistic, dof, chi_square_sf(statistic, dof)
+
+
+def ks_test(samples, dist):
+    """
+    One-sample Kolmogorov-Smirnov test against an exact distribution
+
+    :param samples: List of sampled values
+    :param dist: Exact distribution
+    :return: Statistic and p-value
+    """
+    n = len(samples)
+    observed = {}
+    for x in samples:
+        observed[x] = observed.get(x, 0) + 1
+
+    statistic = 0
+    empirical = cumulative = 0
+    for x in sorted(set(dist) | set(observed)):
+        empirical += observed.get(x, 0) / n
+        cumulative += dist.get(x, 0)
+        statistic = max(statistic, abs(empirical - cumulative))
+    return statistic, kolmogorov_sf(statistic, n)
+
+
+class ConformanceResult:
+    def __init__(self, roll, sampler, samples, chi_square, dof, chi_square_p, ks, ks_p, alpha):
+        """
+        Result of testing one sampler against one corpus entry
+
+        :param roll: Roll that was sampled
+        :param sampler: Name of the sampler
+        :param samples: Number of samples drawn
+        :param chi_square: Chi-square statistic
+        :param dof: Degrees of freedom of the chi-square test
+        :param chi_square_p: p-value of the chi-square test
+        :param ks: Kolmogorov-Smirnov statistic
+        :param ks_p: p-value of the Kolmogorov-Smirnov test
+        :param alpha: Significance level below which the sampler fails
+        """
+        self.roll = roll
+        self.sampler = sampler
+        self.samples = samples
+        self.chi_square = chi_square
+        self.dof = dof
+        self.chi_square_p = chi_square_p
+        self.ks = ks
+        self.ks_p = ks_p
+        self.alpha = alpha
+
+    @property
+    def passed(self):
+        return self.chi_square_p >= self.alpha and self.ks_p >= self.alpha
+
+    def __str__(self):
+        return '%s %-12s %-14s chi2=%.2f (dof %d, p=%.4f) ks=%.4f (p=%.4f)' % (
+            'PASS' if self.passed else 'FAIL', self.sampler, self.roll,
+            self.chi_square, self.dof, self.chi_square_p, self.ks, self.ks_p)
+
+
+# Known-wrong samplers for the self-test: a corpus roll, and the roll sampled in its place
+MUTANTS = [
+    ('4d6R', '4d6r', 'reroll once instead of until'),
+    ('4d6r', '4d6R', 'reroll until instead of once'),
+    ('3d6!p', '3d6!', 'explode instead of penetrate'),
+    ('3d6!', '3d6!p', 'penetrate instead of explode'),
+    ('5d6X2', '5d6X', 'drop one instead of two'),
+    ('5d6x', '5d6x2', 'drop two instead of one'),
+]
+
+
+def check(roll, dist, sampler=_sample_roll_dice, *, name='roll_dice', samples=None, seed=DEFAULT_SEED,
+          alpha=None):
+    """
+    Samples a roll and tests the samples against an exact distribution.
+    The global random state is seeded for the run and restored afterwards.
+
+    :param roll: Roll in dice notation
+    :param dist: Exact distribution of the roll
+    :param sampler: Function taking a roll and returning a single result
+    :param name: Name of the sampler, for reporting
+    :param samples: Number of samples to draw. Defaults to required_samples for the distribution
+    :param seed: Seed for the random module
+    :param alpha: Significance level below which the sampler fails. Defaults to FAMILY_ALPHA
+    :return: ConformanceResult
+    """
+    alpha = FAMILY_ALPHA if alpha is None else alpha
+    samples = required_samples(dist, alpha) if samples is None else samples
+    state = random.getstate()
+    random.seed('%s:%s' % (seed, roll))
+    try:
+        values = [sampler(roll) for i in range(samples)]
+    finally:
+        random.setstate(state)
+
+    chi_square, dof, chi_square_p = chi_square_test(values, dist)
+    ks, ks_p = ks_test(values, dist)
+    return ConformanceResult(roll, name, samples, chi_square, dof, chi_square_p, ks, ks_p, alpha)
+
+
+def run(corpus=None, samplers=None, *, samples=None, seed=DEFAULT_SEED, alpha=None):
+    """
+    Tests every sampler against every corpus entry
+
+    :param corpus: List of (roll, distribution) pairs. Defaults to CORPUS
+    :param samplers: Dict of sampler name to sampler function. Defaults to SAMPLERS
+    :param samples: Number of samples to draw per roll. Defaults to required_samples for each roll
+    :param seed: Seed for the random module
+    :param alpha: Significance level below which a sampler fails. Defaults to FAMILY_ALPHA split over the checks
+    :return: List of ConformanceResult
+    """
+    corpus = CORPUS if corpus is None else corpus
+    samplers = SAMPLERS if samplers is None else samplers
+    alpha = FAMILY_ALPHA / (len(corpus) * len(samplers)) if alpha is None else alpha
+    return [check(roll, dist, sampler, name=name, samples=samples, seed=seed, alpha=alpha)
+            for name, sampler in samplers.items() for roll, dist in corpus]
+
+
+def self_test(*, samples=None, seed=DEFAULT_SEED, alpha=None):
+    """
+    Samples each of MUTANTS in place of its corpus roll, which the harness has to catch
+
+    :param samples: Number of samples to draw per roll. Defaults to required_samples for each roll
+    :param seed: Seed for the random module
+    :param alpha: Significance level below which a sampler fails. Defaults to the one run uses
+    :return: List of (description, ConformanceResult) for the mutants that were not caught
+    """
+    dists = dict(CORPUS)
+    alpha = FAMILY_ALPHA / (len(CORPUS) * len(SAMPLERS)) if alpha is None else alpha
+    missed = []
+    for roll, wrong, description in MUTANTS:
+        result = check(roll, dists[roll], lambda roll, wrong=wrong: _sample_compiled(wrong), name=description,
+                       samples=samples, seed=seed, alpha=alpha)
+        if result.passed:
+            missed.append((description, result))
+    return missed
+
+
+def main(argv=None):
+    """
+    Runs the self-test and the harness and prints a report
+
+    :param argv: Optional sample count and seed
+    :return: Exit status, non-zero if any sampler failed or a known-wrong sampler passed
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    samples = int(argv[0]) if len(argv) > 0 else None
+    seed = int(argv[1]) if len(argv) > 1 else DEFAULT_SEED
+
+    missed = self_test(samples=samples, seed=seed)
+    for description, result in missed:
+        print('self-test: %s was not caught: %s' % (description, result))
+    print('%d of %d known-wrong samplers were not caught' % (len(missed), len(MUTANTS)))
+
+    results = run(samples=samples, seed=seed)
+    for result in results:
+        print(result)
+    failed = len([r for r in results if not r.passed])
+    print('%d of %d checks failed' % (failed, len(results)))
+    return 1 if failed or missed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,8 @@ import ast
 import regex
 import operator
 import math
-import sys
+import functools
+from array import array
 
 class DiceGroupException(Exception):  # Exception for when dice group is malformed, ie '12d6>7!'
     def __init__(self, *args, **kwargs):
@@ -27,6 +28,30 @@ class DiceOperatorException(Exception):  # Exception for when incorrect or malfo
         Exception.__init__(self, *args, **kwargs)
 
 
+class DiceDiagnostic:
+    def __init__(self, group, position, reason):
+        """
+        A problem found while validating a roll
+
+        :param group: The offending dice group or operator
+        :param position: Index of the offending group in the roll
+        :param reason: Why the group is invalid
+        """
+        self.group = group
+        self.position = position
+        self.reason = reason
+
+    def __eq__(self, other):
+        return isinstance(other, DiceDiagnostic) and \
+            (self.group, self.position, self.reason) == (other.group, other.position, other.reason)
+
+    def __repr__(self):
+        return 'DiceDiagnostic(%r, %r, %r)' % (self.group, self.position, self.reason)
+
+    def __str__(self):
+        return '"%s" at position %d: %s' % (self.group, self.position, self.reason)
+
+
 def gcd(a, b):
     """
     Computes GCD using Euclid's algorithm
@@ -128,22 +153,18 @@ class SimpleEval(object):
 
         self.functions = DEFAULT_FUNCTIONS
 
-        if sys.version_info < (3, 8):
-            self.nodes = {
-                ast.Num: self._eval_num,
-                ast.UnaryOp: self._eval_unaryop,
-                ast.BinOp: self._eval_binop,
-            }
-        else:
-            self.nodes = {
-                ast.Constant: self._eval_num,
-                ast.UnaryOp: self._eval_unaryop,
-                ast.BinOp: self._eval_binop,
-            }
+        self.nodes = {
+            ast.Constant: self._eval_num,
+            ast.UnaryOp: self._eval_unaryop,
+            ast.BinOp: self._eval_binop,
+        }
 
         if functions:
             self.nodes[ast.Call] = self._eval_call
 
+        self.nodes[ast.Name] = self._eval_name
+        self.names = {}
+
     def eval(self, expr):
         """
         Evaluates an expression
@@ -158,6 +179,17 @@ class SimpleEval(object):
         # and evaluate:
         return self._eval(ast.parse(expr.strip()).body[0].value)
 
+    def eval_node(self, node, names=None):
+        """
+        Evaluates an already parsed expression
+
+        :param node: AST node to evaluate
+        :param names: Dict of values for the names in the expression
+        :return: Result of expression
+        """
+        self.names = names or {}
+        return self._eval(node)
+
     def _eval(self, node):
         """
         Evaluate a node
@@ -180,9 +212,21 @@ class SimpleEval(object):
         :return: Result of node
         """
         if self.floats:
-            return node.n
+            return node.value
         else:
-            return int(node.n)
+            return int(node.value)
+
+    def _eval_name(self, node):
+        """
+        Evaluate a name, only names given to eval_node are available
+
+        :param node: Node to eval
+        :return: Value of the name
+        """
+        try:
+            return self.names[node.id]
+        except KeyError:
+            raise NameError(node.id)
 
     def _eval_unaryop(self, node):
         """
@@ -229,19 +273,137 @@ class SimpleEval(object):
             return value
 
 
+class RollHistory:
+    __slots__ = ('capacity', '_results', '_convert', '_next', 'count', 'mean', '_squares', 'minimum', 'maximum',
+                 'histogram', 'streak_value', 'streak', 'run', 'skipped')
+
+    def __init__(self, capacity, typecode='d'):
+        """
+        Fixed-capacity history of roll results. The most recent results are kept in a ring buffer, and the statistics
+        are updated in constant time with every result, covering every result since the last reset.
+
+        :param capacity: Number of results kept in the buffer
+        :param typecode: 'd' to keep results as floats or 'q' to keep them as 64-bit integers. Every result is
+            converted once, so the buffer, statistics and histogram agree
+        """
+        if capacity < 1:
+            raise ValueError('History capacity must be positive')
+        if typecode not in ('d', 'q'):
+            raise ValueError("History typecode must be 'd' or 'q'")
+        self.capacity = capacity
+        self._results = array(typecode, bytes(8 * capacity))  # Allocated once, results overwrite the oldest slot
+        self._convert = float if typecode == 'd' else int
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every result and statistic, keeping the buffer
+        """
+        self._next = 0
+        self.count = 0
+        self.mean = 0.0
+        self._squares = 0.0  # Sum of squared differences from the mean, see Welford's algorithm
+        self.minimum = None
+        self.maximum = None
+        self.histogram = {}  # Number of times each result came up
+        self.streak_value = None  # Result repeated in the current streak
+        self.streak = 0  # Number of times in a row streak_value came up
+        self.run = 0  # Number of results in a row above the previous one if positive, below if negative
+        self.skipped = 0  # Number of results too large to record
+
+    def add(self, result):
+        """
+        Records a result. Results that don't fit in the buffer, ie. integers outside of 64 bits for 'q' histories,
+        are only counted in skipped.
+
+        :param result: Result of a roll
+        :return: None
+        """
+        previous = self._results[self._next - 1]
+        try:
+            result = self._convert(result)
+            self._results[self._next] = result
+        except OverflowError:
+            self.skipped += 1
+            return
+
+        if self.count:
+            if result == self.streak_value:
+                self.streak += 1
+            else:
+                self.streak_value, self.streak = result, 1
+            if result > previous:
+                self.run = self.run + 1 if self.run > 0 else 1
+            elif result < previous:
+                self.run = self.run - 1 if self.run < 0 else -1
+            else:
+                self.run = 0
+            if result < self.minimum:
+                self.minimum = result
+            elif result > self.maximum:
+                self.maximum = result
+        else:
+            self.streak_value, self.streak = result, 1
+            self.minimum = self.maximum = result
+
+        self._next = (self._next + 1) % self.capacity
+        self.count += 1
+        delta = result - self.mean
+        self.mean += delta / self.count
+        self._squares += delta * (result - self.mean)
+        self.histogram[result] = self.histogram.get(result, 0) + 1
+
+    @property
+    def variance(self):
+        """
+        :return: Population variance of every result since the last reset
+        """
+        return self._squares / self.count if self.count else 0.0
+
+    @property
+    def results(self):
+        """
+        :return: List of the results in the buffer, oldest first
+        """
+        if self.count < self.capacity:
+            return self._results[:self._next].tolist()
+        return (self._results[self._next:] + self._results[:self._next]).tolist()
+
+    def snapshot(self):
+        """
+        Copies the history and its statistics
+
+        :return: Dictionary of count, mean, variance, minimum, maximum, histogram, streak_value, streak, run,
+            skipped and results
+        """
+        return {'count': self.count, 'mean': self.mean, 'variance': self.variance, 'minimum': self.minimum,
+                'maximum': self.maximum, 'histogram': dict(self.histogram), 'streak_value': self.streak_value,
+                'streak': self.streak, 'run': self.run, 'skipped': self.skipped, 'results': self.results}
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __repr__(self):
+        return 'RollHistory(%d of %d results, mean %s)' % (len(self), self.capacity, self.mean)
+
+
 class DiceBag:
-    def __init__(self, roll='0', *, functions=True, floats=True):  # Initialize dicebag with a default roll of a 0 literal
+    def __init__(self, roll='0', *, functions=True, floats=True, history=0):  # Initialize dicebag with a default roll of a 0 literal
         """
         Initializes dicebag.
 
         :param roll: Roll to initialize with or if no roll is supplied, '0'
         :param functions: Whether to allow function calls. Defaults to yes
         :param floats: Whether to allow for parsing floats. Defaults to yes. When set to false division will act as floor division
+        :param history: Number of results to keep in a RollHistory. Defaults to 0, keeping no history. Results are kept as
+            64-bit integers when floats are disabled and as floats otherwise
         :return: None
         """
         self._roll = None
         self._last_roll = None
         self._last_explanation = None
+        self._last_state = None
+        self._history = RollHistory(history, 'd' if floats else 'q') if history else None
         self.floats = floats
         self.functions = functions
 
@@ -253,10 +415,29 @@ class DiceBag:
 
         :return: Roll results.
         """
-        roll = roll_dice(self.roll, floats=self.floats, functions=self.functions)
+        state = RollState(self.roll, floats=self.floats, functions=self.functions)
 
-        self._last_roll = roll[0]
-        self._last_explanation = roll[1]
+        self._last_state = state
+        self._last_roll = state.result
+        self._last_explanation = state.explanation
+        if self._history is not None:
+            self._history.add(state.result)
+
+        return self.last_roll, self.last_explanation
+
+    def reroll(self, group_index, die_indices=None):
+        """
+        Rerolls some dice of the last roll, keeping every other die, and updates last_roll and last_explanation.
+        Rerolls are not recorded in the history.
+
+        :param group_index: Index of the dice group, in the order the groups appear in the roll
+        :param die_indices: Indices of the dice in that group to reroll. Defaults to the whole group
+        :return: Roll results.
+        """
+        if self._last_state is None:
+            raise ValueError('Nothing has been rolled yet')
+
+        self._last_roll, self._last_explanation = self._last_state.reroll(group_index, die_indices)
 
         return self.last_roll, self.last_explanation
 
@@ -285,14 +466,12 @@ class DiceBag:
         :param value: Roll
         :return: None
         """
-        if type(value) != str:  # Make sure dice roll is a str
-            raise TypeError('Dice roll must be a string in dice notation')
-        try:
-            roll_dice(value)  # Make sure dice roll parses as a valid roll and not an error
-        except Exception as e:
-            raise ValueError('Dice roll specified was not a valid diceroll.\n%s\n' % str(e))
-        else:
-            self._roll = value
+        check_roll(value, functions=self.functions, floats=self.floats)
+        if value != self._roll:
+            self._last_state = None  # Dice of another roll can't be rerolled
+            if self._history is not None:  # Results of another roll don't belong together
+                self._history.reset()
+        self._roll = value
 
     @property
     def last_roll(self):
@@ -312,6 +491,97 @@ class DiceBag:
         """
         return self._last_explanation
 
+    @property
+    def last_state(self):
+        """
+        Standard getter. State of every dice group of the last roll, see RollState.
+
+        :return:
+        """
+        return self._last_state
+
+    @property
+    def history(self):
+        """
+        Standard getter. RollHistory of the results of roll_dice, or None if the dicebag keeps no history.
+
+        :return:
+        """
+        return self._history
+
+
+class Die:
+    BULK_LIMIT = 2 ** 32  # Above this many faces random.choices is no longer uniform enough
+
+    def __init__(self, faces, name):
+        """
+        A single die with an arbitrary set of faces. Use get_die to get cached dice instead of creating them.
+
+        :param faces: Sequence of faces, used as a lookup table. Repeated faces are rolled proportionally more often
+        :param name: Name of the die for explanations, ie. d6, dF
+        """
+        self.faces = faces
+        self.name = name
+        self.values = sorted(set(faces)) if not isinstance(faces, range) else faces
+        self.min = self.values[0]
+        self.max = self.values[-1]
+        self._bulk = not isinstance(faces, range) or faces.stop <= self.BULK_LIMIT
+
+    def roll(self, num_of_dice=1):
+        """
+        Rolls the die a number of times
+
+        :param num_of_dice: Number of times to roll
+        :return: List of results
+        """
+        if self._bulk:
+            return random.choices(self.faces, k=num_of_dice)  # Indexes straight into the face table
+        return [random.randint(1, self.max) for i in range(num_of_dice)]
+
+    def __repr__(self):
+        return 'Die(%s)' % self.name
+
+    def __str__(self):
+        return self.name
+
+
+FUDGE_FACES = (-1, 0, 1)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_die(sides):
+    """
+    Gets the die for a sides specifier. Dice are cached in a bounded cache so their tables are only built once.
+
+    :param sides: Number of sides, F for a Fudge die or a face list such as {0,0,1,1,2,3}
+    :return: Die
+    """
+    sides = str(sides)
+    if sides in ('F', 'f'):
+        faces = FUDGE_FACES
+        name = 'dF'
+    elif sides.startswith('{'):
+        faces = tuple(sorted(int(face) for face in sides[1:-1].split(',')))
+        name = 'd{%s}' % ','.join(str(face) for face in faces)
+    else:
+        if int(sides) < 1:
+            raise ValueError('Dice must have at least one side')
+        faces = range(1, int(sides) + 1)
+        name = 'd%d' % int(sides)
+
+    return Die(faces, name)
+
+
+def _parse_dice(group):
+    """
+    Parses the number and kind of dice at the start of a dice group
+
+    :param group: Dice group, ie. 4d6K3
+    :return: Number of dice and the Die
+    """
+    dice = DICE_PATTERN.match(group)
+    return int(dice[1]) if dice[1] != '' else 1, get_die(dice[2])
+
 
 def zero_width_split(pattern, string):
     """
@@ -329,20 +599,15 @@ def zero_width_split(pattern, string):
 
 def roll_group(group):
     """
-    Rolls a group of dice in 2d6, 3d10, d12, etc. format
+    Rolls a group of dice in 2d6, 3d10, d12, 4dF, 3d{0,1,2}, etc. format
 
     :param group: String of dice group
     :return: Array of results
     """
-    group = regex.match(r'^(\d*)d(\d+)$', group, regex.IGNORECASE)
-    num_of_dice = int(group[1]) if group[1] != '' else 1
-    type_of_dice = int(group[2])
+    num_of_dice, die = _parse_dice(group)
     assert num_of_dice > 0
 
-    result = []
-    for i in range(num_of_dice):
-        result.append(random.randint(1, type_of_dice))
-    return result
+    return die.roll(num_of_dice)
 
 
 def num_equal(result, operator, comparator):
@@ -365,522 +630,996 @@ def num_equal(result, operator, comparator):
         raise ValueError
 
 
-def roll_dice(roll, *, functions=True, floats=True):
+OPERATORS = '()/=<>,%^+*-'
+
+SPLIT_PATTERN = regex.compile(r'((?<=[\(\),%^\/+*-])(?=.)(?![^{}]*\}))|((?<=.)(?=[\(\),%^\/+*-])(?![^{}]*\}))')  # Boundary between operators and other chars, outside of face lists
+
+SIDES = r'(?:\d+|F|\{-?\d+(?:,-?\d+)*\})'  # Number of sides, F for Fudge dice or a list of faces, ie. {0,0,1,1,2,3}
+
+DICE_PATTERN = regex.compile(r'^(\d*)d(' + SIDES + r')', regex.IGNORECASE)  # Number and kind of dice, ie. 4d6, d%, 4dF
+
+MODIFIER_PATTERN = regex.compile(r"""
+    [Rr](?:(?P<reroll_comparison>[<>])?(?P<reroll_comparator>\d+))?|  # Reroll on the lowest face, a number or a comparison, ie. R, r6, R>4
+    !(?P<penetrate>[pP])?(?:(?P<explode_comparison>[<>])?(?P<explode_comparator>\d+))?|  # Explode or penetrate, ie. !, !p10, !>8
+    [asm](?P<individual_number>\d+)|  # Modifier on each die, ie. a2, m3
+    [KkXx](?P<keep_number>\d*)|  # Keep or drop, ie. K3, x
+    (?P<success_comparison>[<>])(?P<success_comparator>\d+)(?:[fF](?P<failure_comparison>[<>])(?P<failure_comparator>\d+))?  # Successes and failures, ie. >7, >6f<3
+    """, regex.VERBOSE)
+
+MODIFIER_STAGES = {'R': 'reroll', 'r': 'reroll', '!': 'explode', 'a': 'individual', 's': 'individual',
+                   'm': 'individual', 'K': 'keep', 'k': 'keep', 'X': 'keep', 'x': 'keep', '<': 'success', '>': 'success'}
+
+LITERAL_PATTERN = regex.compile(r'^\d+$')  # Number literals
+FLOAT_PATTERN = regex.compile(r'^(\.\d+|\d+\.\d+)$')  # Floats
+
+FUNCTION_ARITY = {'abs': (1, 1), 'gcd': (2, 2), 'lcm': (2, 2), 'ceil': (1, 1), 'floor': (1, 1), 'prime': (1, 1),
+                  'max': (2, None), 'min': (2, None)}
+
+
+def tokenize(roll):
     """
-    Rolls dice in dice notation with advanced syntax used according to tinyurl.com/pydice
+    Splits a roll into operators and dice groups, ignoring whitespace
 
     :param roll: Roll in dice notation
-    :return: Result of roll, and an explanation string
+    :return: List of (token, position) tuples, position being the index of the token in the original roll
     """
-    roll = ''.join(roll.split())
-    roll = regex.sub(r'(?<=d)%', '100', roll, regex.IGNORECASE)
-    roll = roll.replace('^', '**')
-    roll = zero_width_split(r'((?<=[\(\),%^\/+*-])(?=.))|((?<=.)(?=[\(\),%^\/+*-]))', roll)  # Split the string on the boundary between operators and other chars
+    chars = []
+    positions = []
+    for position, char in enumerate(roll):
+        if char.isspace():
+            continue
+        if char == '^':
+            char = '**'
+        elif char == '%' and chars and chars[-1] in 'dD':  # d% is a percentile die
+            char = '100'
+        chars.append(char)
+        positions.extend([position] * len(char))
 
-    string = []
+    roll = ''.join(chars)
+    starts = [0] + [m.end() for m in SPLIT_PATTERN.finditer(roll)]
+    ends = starts[1:] + [len(roll)]
+    return [(roll[start:end], positions[start] if start < len(positions) else len(roll)) for start, end in zip(starts, ends)]
 
-    results = []
 
-    for group in roll:
-        if group in '()/=<>,%^+*-' or group in DEFAULT_FUNCTIONS: #Append operators without modification
-            results.append(group)
-            string.append(group)
-            continue
+def _check_comparison(comparison, comparator, die, values=None):
+    """
+    Checks that some but not all values of a die pass a comparison
+
+    :param comparison: '<', '>' or '=' for a specific number
+    :param comparator: Value to compare to
+    :param die: Die the comparison is made on
+    :param values: Sorted values the die can take, defaults to its faces
+    :return: Reason the comparison is invalid, or None
+    """
+    values = die.values if values is None else values
+    if comparison == '=':
+        if comparator not in values:
+            return 'comparator %d is not a face of a %s' % (comparator, die)
+    elif comparison == '>' and not values[0] <= comparator < values[-1]:
+        return 'comparator >%d is out of range for a %s' % (comparator, die)
+    elif comparison == '<' and not values[0] < comparator <= values[-1]:
+        return 'comparator <%d is out of range for a %s' % (comparator, die)
+    return None
+
+
+def _all_pass(values, comparison, comparator):
+    """
+    :param values: Sorted values
+    :param comparison: '<', '>' or '=' for a specific number
+    :param comparator: Value to compare to
+    :return: Whether every value passes the comparison
+    """
+    if comparison == '<':
+        return values[-1] < comparator
+    elif comparison == '>':
+        return values[0] > comparator
+    return values[0] == values[-1] == comparator
+
+
+def _surviving_faces(die, comparison, comparator):
+    """
+    Faces a die can end up showing when it is rerolled until it stops matching a comparison
+
+    :param die: Die rerolled
+    :param comparison: '<', '>' or '=' for a specific number
+    :param comparator: Value to compare to
+    :return: Sorted faces. For standard dice a face rerolled from the middle is left in, since only the
+        lowest and highest face and whether they differ are used
+    """
+    if not isinstance(die.values, range):
+        test = _condition(comparison, comparator)
+        return [x for x in die.values if not test(x)]
+    low, high = die.min, die.max
+    if comparison == '<':
+        low = comparator
+    elif comparison == '>':
+        high = comparator
+    elif comparator == low:
+        low += 1
+    elif comparator == high:
+        high -= 1
+    return range(low, high + 1)
+
+
+def _condition(comparison, comparator):
+    """
+    Builds a test for a die comparison
+
+    :param comparison: '<', '>' or '=' for a specific number
+    :param comparator: Value to compare to
+    :return: Function taking a die value and returning whether it passes
+    """
+    if comparison == '<':
+        return lambda x: x < comparator
+    elif comparison == '>':
+        return lambda x: x > comparator
+    return lambda x: x == comparator
+
+
+class DiceGroup:
+    def __init__(self, text, num_of_dice, die, *, reroll=None, explode=None, individual=None, keep=None,
+                 success=None, failure=None):
+        """
+        A parsed dice group. Rolling runs its modifiers in order: reroll, explode, individual modifier,
+        keep/drop and finally counting successes and failures.
+
+        :param text: Dice group as written, ie. 4d6K3
+        :param num_of_dice: Number of dice rolled
+        :param die: Die rolled
+        :param reroll: (comparison, comparator, once) to reroll dice on, or None
+        :param explode: (comparison, comparator, penetrate) to explode dice on, or None
+        :param individual: (operator, number) applied to each die, operator being 'a', 's' or 'm', or None
+        :param keep: (mode, number) with mode 'K', 'k', 'X' or 'x', or None
+        :param success: (comparison, comparator) counting a success, or None
+        :param failure: (comparison, comparator) counting a failure, or None
+        """
+        self.text = text
+        self.num_of_dice = num_of_dice
+        self.die = die
+        self.reroll = reroll
+        self.explode = explode
+        self.individual = individual
+        self.keep = keep
+        self.success = success
+        self.failure = failure
+
+        self.reroll_test = _condition(*reroll[:2]) if reroll is not None else None
+        self.explode_test = _condition(*explode[:2]) if explode is not None else None
+        self.success_test = _condition(*success) if success is not None else None
+        self.failure_test = _condition(*failure) if failure is not None else None
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parses a dice group. Modifiers can be combined and written in any order, but each stage only once,
+        ie. 4d6r1K3, 10d10!>8>7 or 6d6a1>4.
+
+        :param text: Dice group, ie. 4d6!K3
+        :return: DiceGroup
+        :raises ValueError: With the reason the group is invalid
+        """
+        dice = DICE_PATTERN.match(text)
+        if dice is None:
+            raise ValueError('not a recognised dice group')
+        num_of_dice = int(dice[1]) if dice[1] != '' else 1
         try:
-            explode = regex.match(r'^((\d*)d(\d+))!$', group, regex.IGNORECASE)  # Regex for exploding dice, ie. 2d10!, 4d100!, d12!, etc.
+            die = get_die(dice[2])
+        except ValueError as e:
+            raise ValueError(str(e).lower())
+        if num_of_dice < 1:
+            raise ValueError('must roll at least one die')
+
+        stages = {}
+        position = dice.end()
+        while position < len(text):
+            match = MODIFIER_PATTERN.match(text, position)
+            if match is None:
+                raise ValueError('unrecognised modifier "%s"' % text[position:])
+            stage = MODIFIER_STAGES[text[position]]
+            if stage in stages:
+                raise ValueError('more than one %s modifier' % stage)
+            stages[stage] = match
+            position = match.end()
+
+        modifiers = {}
+        if 'reroll' in stages:
+            match = stages['reroll']
+            modifiers['reroll'] = (match['reroll_comparison'] or '=',
+                                   int(match['reroll_comparator']) if match['reroll_comparator'] else die.min,
+                                   match[0][0] == 'r')
+        if 'explode' in stages:
+            match = stages['explode']
+            modifiers['explode'] = (match['explode_comparison'] or '=',
+                                    int(match['explode_comparator']) if match['explode_comparator'] else die.max,
+                                    match['penetrate'] is not None)
+        if 'individual' in stages:
+            match = stages['individual']
+            modifiers['individual'] = (match[0][0], int(match['individual_number']))
+        if 'keep' in stages:
+            match = stages['keep']
+            modifiers['keep'] = (match[0][0], int(match['keep_number']) if match['keep_number'] else 1)
+        if 'success' in stages:
+            match = stages['success']
+            modifiers['success'] = (match['success_comparison'], int(match['success_comparator']))
+            if match['failure_comparison'] is not None:
+                modifiers['failure'] = (match['failure_comparison'], int(match['failure_comparator']))
+
+        group = cls(text, num_of_dice, die, **modifiers)
+        reason = group._check()
+        if reason is not None:
+            raise ValueError(reason)
+        return group
+
+    def _check(self):
+        """
+        Checks that every stage of the group can be rolled and that its comparisons can both pass and fail
+
+        :return: Reason the group is invalid, or None
+        """
+        die = self.die
+        faces = die.values  # Faces a die can show once it has been rerolled
+        if self.reroll is not None:
+            comparison, comparator, once = self.reroll
+            reason = _check_comparison(comparison, comparator, die)
+            if reason is not None:
+                return reason
+            if not once:
+                if die.min == die.max:
+                    return 'reroll on a %s would never stop' % die
+                faces = _surviving_faces(die, comparison, comparator)
+
+        if self.explode is not None:
+            comparison, comparator, penetrate = self.explode
+            reason = _check_comparison(comparison, comparator, die)
+            if reason is not None:
+                return reason
+            if _all_pass(faces, comparison, comparator):
+                return 'explosion on a %s would never stop' % die
+
+        if self.keep is not None:
+            mode, number = self.keep
+            if not 1 <= number < self.num_of_dice:
+                return 'can only %s between 1 and %d dice' % ('keep' if mode in 'Kk' else 'drop', self.num_of_dice - 1)
+
+        if self.success is not None:
+            low, high = faces[0], faces[-1]  # Range of the values counted
+            if self.explode is not None and self.explode[2]:
+                low -= 1
+            if self.individual is not None:
+                operator, number = self.individual
+                if operator == 'a':
+                    low, high = low + number, high + number
+                elif operator == 's':
+                    low, high = low - number, high - number
+                else:
+                    low, high = low * number, high * number
+            reason = _check_comparison(*self.success, die, (low, high))
+            if reason is None and self.failure is not None:
+                if self.failure[0] == self.success[0]:
+                    return 'success and failure comparisons must point in opposite directions'
+                reason = _check_comparison(*self.failure, die, (low, high))
+            return reason
+        return None
+
+    def roll(self):
+        """
+        Rolls the group
+
+        :return: GroupRoll
+        """
+        return GroupRoll(self)
+
+    def __repr__(self):
+        return 'DiceGroup(%r)' % self.text
+
+
+class GroupRoll:
+    def __init__(self, group):
+        """
+        The state of a rolled dice group. Every die rolled, including explosions, has an entry in a set of
+        parallel arrays ordered by explosion level and then by the original die it came from.
+
+        :param group: DiceGroup to roll
+        """
+        self.group = group
+        self.faces = group.die.roll(group.num_of_dice)  # Face showing on each die
+        self.origins = list(range(group.num_of_dice))  # Index of the original die each die exploded from
+        self.levels = [0] * group.num_of_dice  # Number of explosions between the original die and each die
+        self.histories = [None] * group.num_of_dice  # Every face rolled by each rerolled die, last one showing
+
+        self._reroll(range(group.num_of_dice))
+        self._explode(range(group.num_of_dice))
+        self._score()
+
+    @property
+    def dice(self):
+        """
+        :return: Face showing on each of the original dice, not counting explosions
+        """
+        return self.faces[:self.group.num_of_dice]
 
-            specific_explode = regex.match(r'^((\d*)d(\d+))!(\d+)$', group)  # Regex for exploding dice on specific number, ie. d20!10 or d12!4
+    def reroll(self, die_indices=None):
+        """
+        Rerolls some of the original dice of the group, along with anything they exploded into, and rescores the group
 
-            comparison_explode = regex.match(r'^((\d*)d(\d+))!([<>])(\d+)$', group, regex.IGNORECASE)  # Regex for exploding dice with a comparison, ie. d20!>10, d6!<2
+        :param die_indices: Indices of the original dice to reroll, defaults to all of them
+        :return: New value of the group
+        """
+        targets = set(range(self.group.num_of_dice) if die_indices is None else die_indices)
+        for index in targets:
+            if not 0 <= index < self.group.num_of_dice:
+                raise IndexError('Die index %d out of range for %s' % (index, self.group.text))
 
-            penetrate = regex.match(r'^((\d*)d(\d+))!p$', group, regex.IGNORECASE)  # Penetrating dice are the same as exploding except any dice after the initial number are added with a -1 penalty
+        if self.group.explode is not None:  # Drop the explosions of the rerolled dice
+            remaining = [i for i in range(len(self.faces)) if self.levels[i] == 0 or self.origins[i] not in targets]
+            self._reorder(remaining)
 
-            specific_penetrate = regex.match(r'^((\d*)d(\d+))!p(\d+)$', group, regex.IGNORECASE)  # See above
+        targets = sorted(targets)
+        for index, face in zip(targets, self.group.die.roll(len(targets))):
+            self.faces[index] = face
+            self.histories[index] = None
+        self._reroll(targets)
+        self._explode(targets)
 
-            comparison_penetrate = regex.match(r'^((\d*)d(\d+))!p([<>])(\d+)$', group, regex.IGNORECASE)  # See above
+        if self.group.explode is not None:  # Put the new explosions back in order
+            self._reorder(sorted(range(len(self.faces)), key=lambda i: (self.levels[i], self.origins[i])))
 
-            reroll = regex.match(r'^((\d*)d(\d+))([Rr])$', group, regex.IGNORECASE) # Reroll on a one, matches 1d6R, 4d12r, etc.
+        self._score()
+        return self.value
 
-            specific_reroll = regex.match(r'^((\d*)d(\d+))([Rr])(\d+)$', group, regex.IGNORECASE) # Reroll on a specific number
+    def _save(self):
+        """
+        :return: Copy of the state of the group, for _restore
+        """
+        return dict(self.__dict__, faces=list(self.faces), origins=list(self.origins), levels=list(self.levels),
+                    histories=list(self.histories), values=list(self.values))  # values can be faces itself
 
-            comparison_reroll =  regex.match(r'^((\d*)d(\d+))([Rr])([<>])(\d+)$', group, regex.IGNORECASE) # Reroll on a comparison
+    def _restore(self, saved):
+        """
+        Puts back a state returned by _save
+        """
+        self.__dict__.update(saved)
 
-            success_comparison = regex.match(r'^((?:\d*)d(\d+))([<>])(\d+)$', group, regex.IGNORECASE)  # Regex for dice with comparison, ie. 2d10>4, 5d3<2, etc.
+    def _reorder(self, order):
+        """
+        Reorders or filters every die array
 
-            success_fail_comparison = regex.match(r'^((?:\d*)d(\d+))(?|((<)(\d+)f(>)(\d+))|((>)(\d+)f(<)(\d+)))$', group, regex.IGNORECASE)  # Regex for dice with success comparison and failure comparison.
+        :param order: Indices of the dice to keep, in their new order
+        """
+        self.faces = [self.faces[i] for i in order]
+        self.origins = [self.origins[i] for i in order]
+        self.levels = [self.levels[i] for i in order]
+        self.histories = [self.histories[i] for i in order]
 
-            keep = regex.match(r'^((?:\d*)d\d+)([Kk])(\d*)$', group, regex.IGNORECASE)  # Regex for keeping a number of dice, ie. 2d10K, 2d10k3, etc.
+    def _reroll(self, indices):
+        """
+        Reroll stage, rerolls dice until they stop matching the reroll condition, or once
 
-            drop = regex.match(r'^((?:\d*)d\d+)([Xx])(\d*)$', group, regex.IGNORECASE)  # As above but with dropping dice and X
+        :param indices: Indices of the dice to check
+        """
+        if self.group.reroll is None:
+            return
+        test = self.group.reroll_test
+        once = self.group.reroll[2]
+        die = self.group.die
+        for i in indices:
+            if test(self.faces[i]):
+                history = [self.faces[i]]
+                history.append(die.roll()[0])
+                while not once and test(history[-1]):
+                    history.append(die.roll()[0])
+                self.faces[i] = history[-1]
+                self.histories[i] = history
+
+    def _explode(self, indices):
+        """
+        Explode stage, rolls a new die for every die matching the explode condition, breadth first.
+        New dice are rerolled before they are checked for further explosions.
 
-            individual = regex.match(r'^((\d*)d(\d+))([asm])(\d+)$', group, regex.IGNORECASE) #Regex for rolling dice with a modifier attached to each roll
+        :param indices: Indices of the dice to check
+        """
+        if self.group.explode is None:
+            return
+        test = self.group.explode_test
+        frontier = [i for i in indices if test(self.faces[i])]
+        while frontier:
+            start = len(self.faces)
+            for parent, face in zip(frontier, self.group.die.roll(len(frontier))):
+                self.faces.append(face)
+                self.origins.append(self.origins[parent])
+                self.levels.append(self.levels[parent] + 1)
+                self.histories.append(None)
+            self._reroll(range(start, len(self.faces)))  # Explosions go through the reroll stage like any other die
+            frontier = [i for i in range(start, len(self.faces)) if test(self.faces[i])]
+
+    def _score(self):
+        """
+        Individual modifier, keep/drop and counting stages. Sets value, values, order and kept.
+        """
+        group = self.group
+        values = self.faces
+        if group.explode is not None and group.explode[2]:  # Penetrating dice get -1 on every explosion
+            values = [face - 1 if level else face for face, level in zip(values, self.levels)]
+        if group.individual is not None:
+            operator, number = group.individual
+            if operator == 'a':
+                values = [x + number for x in values]
+            elif operator == 's':
+                values = [x - number for x in values]
+            else:
+                values = [x * number for x in values]
+        self.values = values
+
+        if group.keep is not None:
+            mode, number = group.keep
+            order = sorted(range(len(values)), key=values.__getitem__, reverse=mode in 'KX')
+            if mode in 'Kk':
+                self.kept = order[:number]
+                self.order = order
+            else:
+                self.kept = order[number:]
+                self.order = self.kept + order[:number]  # Kept dice are shown first
+        else:
+            self.kept = self.order = range(len(values))
 
-            normal = regex.match(r'^((\d*)d(\d+))$', group, regex.IGNORECASE)  # Regex for normal dice rolls
+        if group.success is not None:
+            success, failure = group.success_test, group.failure_test
+            self.value = sum(1 if success(values[i]) else (-1 if failure is not None and failure(values[i]) else 0)
+                             for i in self.kept)
+        else:
+            self.value = sum(values[i] for i in self.kept)
+        self._text = None
 
-            literal = regex.match(r'^(\d+)(?!\.)$', group, regex.IGNORECASE)  # Regex for number literals.
+    def _render(self, i):
+        """
+        Renders one die for the explanation
 
-            float_literal = regex.match(r'^(\.\d+)|(\d+.\d+)$', group, regex.IGNORECASE) # Regex for floats
+        :param i: Index of the die
+        :return: String such as 6, !6, 5~1, !6-1, 3a2 or *1
+        """
+        group = self.group
+        history = self.histories[i]
+        text = str(self.faces[i]) if history is None else '~'.join(str(x) for x in reversed(history))
+        if group.explode is not None:
+            if group.explode_test(self.faces[i]):
+                text = '!' + text
+            if group.explode[2] and self.levels[i]:
+                text += '-1'
+        if group.individual is not None:
+            text += '%s%d' % group.individual
+        if group.success is not None:
+            if group.success_test(self.values[i]):
+                text = '!' + text
+            elif group.failure is not None and group.failure_test(self.values[i]):
+                text = '*' + text
+        return text
 
-            if explode is not None:  # Handle exploding dice without a comparison modifier.
-                type_of_dice = int(explode[3])
+    @property
+    def text(self):
+        """
+        :return: Explanation of the group, ie. [6,5,4 ~~ 1]
+        """
+        if self._text is None:
+            dice = [self._render(i) for i in self.order]
+            if self.group.keep is not None:
+                kept = len(self.kept)
+                self._text = '[%s ~~ %s]' % (','.join(dice[:kept]), ','.join(dice[kept:]))
+            else:
+                self._text = '[%s]' % ','.join(dice)
+        return self._text
 
-                result = []
-                last_result = roll_group(explode[1])
-                result.extend(last_result)
-                number_to_roll = num_equal(last_result, '=', type_of_dice)
-                while number_to_roll != 0:
-                    last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice)) # Reroll dice
-                    result.extend(last_result)
-                    number_to_roll = num_equal(last_result, '=', type_of_dice) # Check how many dice we have to reroll again
 
-                results.append(sum(result))
-                roll = ','.join([('!' + str(i) if i == type_of_dice else str(i)) for i in result])  # Build a string of the dice rolls, adding an exclamation mark before every roll that resulted in an explosion.
-                string.append('[%s]' % roll)
+@functools.lru_cache(maxsize=4096)
+def parse_group(group, floats=True):
+    """
+    Parses a token of a roll that is not an operator
 
-            elif specific_explode is not None:  # Handle exploding dice without a comparison modifier.
-                type_of_dice = int(specific_explode[3])
+    :param group: Token, ie. 17, 2.5 or 4d6!K3
+    :param floats: Whether floats are allowed
+    :return: int or float for literals, DiceGroup for dice groups
+    :raises ValueError: With the reason the token is invalid
+    """
+    if LITERAL_PATTERN.match(group):
+        return int(group)
+    if FLOAT_PATTERN.match(group):
+        if not floats:
+            raise ValueError('floats are disabled')
+        return float(group)
+    return DiceGroup.parse(group)
 
-                comparator = int(specific_explode[4])
 
-                assert  0 < comparator <= type_of_dice
+@functools.lru_cache(maxsize=1024)
+def _parse_roll(roll, floats=True):
+    """
+    Parses a roll once. Every dice group becomes a DiceGroup and the arithmetic becomes an AST
+    with the names _g0, _g1, ... standing in for the value of each dice group.
 
-                result = []
-                last_result = roll_group(specific_explode[1])
-                result.extend(last_result)
-                number_to_roll = num_equal(last_result, '=', comparator)
-                while number_to_roll != 0:
-                    last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                    result.extend(last_result)
-                    number_to_roll = num_equal(last_result, '=', comparator)
+    :param roll: Roll in dice notation
+    :param floats: Whether to allow floats
+    :return: Explanation fragments with None in place of each dice group, the DiceGroups, the AST and
+        (offset in the AST source, token, position in the roll) of every token
+    """
+    fragments = []
+    groups = []
+    template = []
+    locations = []
+    offset = 0
+
+    for group, position in tokenize(roll):
+        locations.append((offset, group, position))
+        if group in OPERATORS or group in DEFAULT_FUNCTIONS:  # Append operators without modification
+            fragments.append(group)
+            template.append(group)
+            offset += len(group)
+            continue
+        try:
+            parsed = parse_group(group, floats)
+        except Exception:
+            raise DiceGroupException('"%s" is not a valid dicegroup.' % group)
 
-                results.append(sum(result))
-                roll = ','.join([('!' + str(i) if i == comparator else str(i)) for i in result])  # Build a string of the dice rolls, adding an exclamation mark before every roll that resulted in an explosion.
-                string.append('[%s]' % roll)
+        if isinstance(parsed, DiceGroup):
+            fragments.append(None)
+            template.append('_g%d' % len(groups))
+            groups.append(parsed)
+        else:
+            fragments.append(group)
+            template.append(repr(parsed))
+        offset += len(template[-1])
 
-            elif comparison_explode is not None:  # Handle exploding dice with a comparison modifier
-                type_of_dice = int(comparison_explode[3])
+    try:
+        body = ast.parse(''.join(template).strip()).body
+        if len(body) != 1 or not isinstance(body[0], ast.Expr):
+            raise SyntaxError('Roll must be a single expression')
+    except Exception:
+        raise DiceOperatorException('Error parsing operators and or functions')
 
-                comparator = int(comparison_explode[5])
+    return tuple(fragments), tuple(groups), body[0].value, tuple(locations)
 
-                if comparison_explode[4] == '>':  # Ensure comparison is within bounds
-                    assert  0 < comparator < type_of_dice
-                else:
-                    assert  1 < comparator <= type_of_dice
-
-                result = []
-                last_result = roll_group(comparison_explode[1])
-                result.extend(last_result)
-                if comparison_explode[4] == '>':
-                    number_to_roll = num_equal(last_result, '>', comparator)
-                    while number_to_roll != 0:
-                        last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                        result.extend(last_result)
-                        number_to_roll = num_equal(last_result, '>', comparator)
-                    roll = ','.join([('!' + str(i) if i > comparator else str(i)) for i in
-                                     result])  # Same as on other explodes except with a > or < comparison
 
-                else:
-                    number_to_roll = num_equal(last_result, '<', comparator)
-                    while number_to_roll != 0:
-                        last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                        result.extend(last_result)
-                        number_to_roll = num_equal(last_result, '<', comparator)
-                    roll = ','.join([('!' + str(i) if i < comparator else str(i)) for i in
-                                     result])  # Same as on other explodes except with a > or < comparison
+def _format_explanation(fragments):
+    """
+    Joins explanation fragments and puts spaces around operators
 
-                results.append(sum(result))
-                string.append('[%s]' % roll)
+    :param fragments: List of operators, literals and group explanations
+    :return: Explanation string
+    """
+    #Create explanation string and remove extraneous spaces
+    explanation = ''.join(fragments)
+    explanation = zero_width_split(r"""((?<=[\/%^+])(?![\/,]))| # Split between /, %, ^, and +
+                                    ((?<![\/,])(?=[\/%^+]))| # Same as above
+                                    ((?<=[^(])(?=-))(?!-[^[]*])| # Split in front of - that are not in a roll
+                                    (?<=-)(?=[^\d()a-z])| # Same for splitting after - and before non-literals
+                                    (?<=[\d)\]]-)(?=.)(?![^[]*])| # Split after a - that is not in a roll
+                                    (?<=,)(?![^[]*])| # Split after a comma that is not in a roll
+                                    (?<=([^,\[]\*))(?!\*)| # Split after a * that is not in a roll
+                                    (?<![,\*\[])(?=\*) # Split before a * that is not in a roll""", explanation) #Split on ops to properly format the explanation
+    explanation = ' '.join(explanation)
+    explanation = explanation.strip()
+    explanation = regex.sub(r'[ \t]{2,}', ' ', explanation)
+    return explanation
 
-            elif penetrate is not None:  # Handle penetrating dice without a comparison modifier.
-                type_of_dice = int(penetrate[3])
 
-                first_num = int(penetrate[2])
+GROUP_PLACEHOLDER = '[\x00]'  # Stands in for a group explanation, the formatter treats it like any [...]
 
-                result = []
-                last_result = roll_group(penetrate[1])
-                result.extend(last_result)
-                number_to_roll = num_equal(last_result, '=', type_of_dice)
-                while number_to_roll != 0:
-                    last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                    result.extend(last_result)
-                    number_to_roll = num_equal(last_result, '=', type_of_dice)
 
-                pre_result = result[:first_num]  # Add the first rolls with no modifier
-                pre_result.extend([x - 1 for x in result[first_num:]])  # Add the second rolls with a -1 modifier
+@functools.lru_cache(maxsize=1024)
+def _explanation_template(roll, floats=True):
+    """
+    Formats the operators and literals of a roll once, leaving a gap for the explanation of each dice group.
+    The formatter never splits inside [...], so group explanations can be spliced into the gaps as they are.
 
-                results.append(sum(pre_result))
+    :param roll: Roll in dice notation
+    :param floats: Whether to allow floats
+    :return: Tuple of formatted text around the groups, one longer than the number of groups
+    """
+    fragments = _parse_roll(roll, floats)[0]
+    return tuple(_format_explanation([GROUP_PLACEHOLDER if fragment is None else fragment
+                                      for fragment in fragments]).split(GROUP_PLACEHOLDER))
 
-                roll = ','.join(['!' + str(i) if i == type_of_dice else str(i) for i in result[:first_num]])  # Add the first numbers, without the -1 but with a ! when roll is penetration
-                roll += (',' if len(pre_result) > first_num else '')  # Only add the comma in between if there's at least one penetration
-                roll += ','.join([('!' + str(i) + '-1' if i == type_of_dice else str(i) + '-1') for i in result[first_num:]])  # Add the penetration dice with the '-1' tacked on the end
-                string.append('[%s]' % roll)
 
-            elif specific_penetrate is not None:  # Handle penetrating dice without a comparison modifier.
-                type_of_dice = int(specific_penetrate[3])
+@functools.lru_cache(maxsize=1024)
+def _parents(tree):
+    """
+    :param tree: AST of a parsed roll
+    :return: Dict of the parent of every node of the AST, and dict of the name node of every dice group
+    """
+    parents = {}
+    names = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+        if isinstance(node, ast.Name):
+            names[node.id] = node
+    return parents, names
+
+
+class _CachingEval(SimpleEval):
+    def __init__(self, *, functions=True, floats=True):
+        """
+        SimpleEval remembering the value of every node, so a change to one name only re-evaluates its ancestors
+        """
+        super().__init__(functions=functions, floats=floats)
+        self.values = {}
+
+    def _eval(self, node):
+        try:
+            return self.values[node]
+        except KeyError:
+            value = self.values[node] = super()._eval(node)
+            return value
 
-                first_num = int(specific_penetrate[2])
+    def forget(self, node, parents):
+        """
+        Forgets the value of a node and every node above it
 
-                comparator = int(specific_penetrate[4])
+        :param node: Changed node
+        :param parents: Parent of every node, from _parents
+        """
+        while node is not None:
+            self.values.pop(node, None)
+            node = parents.get(node)
 
-                assert 0 < comparator <= type_of_dice
 
-                result = []
-                last_result = roll_group(specific_penetrate[1])
-                result.extend(last_result)
-                number_to_roll = num_equal(last_result, '=', comparator)
-                while number_to_roll != 0:
-                    last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                    result.extend(last_result)
-                    number_to_roll = num_equal(last_result, '=', comparator)
+class RollState:
+    def __init__(self, roll, *, functions=True, floats=True):
+        """
+        Rolls dice in dice notation and keeps the state of every dice group so parts of it can be rerolled
+
+        :param roll: Roll in dice notation
+        :param functions: Whether to allow function calls
+        :param floats: Whether to allow floats. When set to false division will act as floor division
+        """
+        self.roll = roll
+        self.functions = functions
+        self.floats = floats
 
-                pre_result = result[:first_num]  # Same as normal penetration
-                pre_result.extend([x - 1 for x in result[first_num:]])
+        fragments, specs, self._tree, locations = _parse_roll(roll, floats)
+        self.groups = [spec.roll() for spec in specs]
+        self._parser = _CachingEval(floats=floats, functions=functions)
+        self._parser.names = {'_g%d' % i: group.value for i, group in enumerate(self.groups)}
+        self._evaluate()
 
-                results.append(sum(pre_result))
+    def _evaluate(self):
+        """
+        Evaluates the arithmetic with the current group values, reusing the value of every unchanged subtree
+        """
+        try:
+            result = self._parser._eval(self._tree)
+            if not self.floats:
+                result = int(result)
+        except Exception:
+            raise DiceOperatorException('Error parsing operators and or functions')
+        self.result = result
+        self._explanation = None
 
-                roll = ','.join(['!' + str(i) if i == comparator else str(i) for i in result[:first_num]])  # Same as above
-                roll += (',' if len(pre_result) > first_num else '')
-                roll += ','.join([('!' + str(i) + '-1' if i == comparator else str(i) + '-1') for i in result[first_num:]])
-                string.append('[%s]' % roll)
+    @property
+    def explanation(self):
+        """
+        :return: Explanation string, built on first use
+        """
+        if self._explanation is None:
+            template = _explanation_template(self.roll, self.floats)
+            parts = [template[0]]
+            for group, text in zip(self.groups, template[1:]):
+                parts.append(group.text)
+                parts.append(text)
+            self._explanation = ''.join(parts)
+        return self._explanation
+
+    def reroll(self, group_index, die_indices=None):
+        """
+        Rerolls some dice of one group, keeping every other die, and re-evaluates the roll. Only the arithmetic
+        depending on the group is evaluated again. If evaluation fails the group is left as it was.
 
-            elif comparison_penetrate is not None:  # Handle penetrating dice without a comparison modifier.
-                type_of_dice = int(comparison_penetrate[3])
+        :param group_index: Index of the dice group, in the order the groups appear in the roll
+        :param die_indices: Indices of the original dice in that group to reroll, defaults to all of them
+        :return: Result of roll, and an explanation string
+        """
+        if not 0 <= group_index < len(self.groups):
+            raise IndexError('Group index %d out of range for %s' % (group_index, self.roll))
+        group = self.groups[group_index]
+        name = '_g%d' % group_index
+        parents, names = _parents(self._tree)
+        saved = group._save()
+
+        group.reroll(die_indices)
+        self._parser.names[name] = group.value
+        self._parser.forget(names[name], parents)
+        try:
+            self._evaluate()
+        except DiceOperatorException:
+            group._restore(saved)
+            self._parser.names[name] = group.value
+            self._parser.forget(names[name], parents)
+            raise
+        return self.result, self.explanation
 
-                comparator = int(comparison_penetrate[5])
 
-                first_num = int(comparison_penetrate[2])
+def _roll(roll, functions=True, floats=True, explain=True):
+    """
+    Rolls dice in dice notation, keeping the value of every dice group
 
-                if comparison_penetrate[4] == '>':  # Ensure comparison is within bounds
-                    assert 0 < comparator < type_of_dice
-                else:
-                    assert 1 < comparator <= type_of_dice
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :param explain: Whether to build the explanation string
+    :return: Result of roll, explanation string or None and a list of the value of each dice group
+    """
+    state = RollState(roll, functions=functions, floats=floats)
+    return state.result, state.explanation if explain else None, [group.value for group in state.groups]
 
-                result = []
-                last_result = roll_group(comparison_penetrate[1])
-                result.extend(last_result)
 
-                # Do penetration based on more than or less than sign.
-                if comparison_penetrate[4] == '>':
-                    number_to_roll = num_equal(last_result, '>', comparator)
-                    while number_to_roll != 0:
-                        last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                        result.extend(last_result)
-                        number_to_roll = num_equal(last_result, '>', comparator)
+def roll_dice(roll, *, functions=True, floats=True):
+    """
+    Rolls dice in dice notation with advanced syntax used according to tinyurl.com/pydice
 
-                else:
-                    number_to_roll = num_equal(last_result, '<', comparator)
-                    while number_to_roll != 0:
-                        last_result = roll_group(str(number_to_roll) + 'd' + str(type_of_dice))
-                        result.extend(last_result)
-                        number_to_roll = num_equal(last_result, '<', comparator)
-
-                pre_result = result[:first_num]
-                pre_result.extend([x - 1 for x in result[first_num:]])
-                results.append(sum(pre_result))
-
-                if comparison_penetrate[4] == '>':
-                    roll = ','.join(
-                        ['!' + str(i) if i > comparator else str(i) for i in result[:first_num]])  # Same as above
-                    roll += (',' if len(pre_result) > first_num else '')
-                    roll += ','.join(
-                        [('!' + str(i) + '-1' if i > comparator else str(i) + '-1') for i in result[first_num:]])
-                else:
-                    roll = ','.join(
-                        ['!' + str(i) if i < comparator else str(i) for i in result[:first_num]])  # Same as above
-                    roll += (',' if len(pre_result) > first_num else '')
-                    roll += ','.join(
-                        [('!' + str(i) + '-1' if i < comparator else str(i) + '-1') for i in result[first_num:]])
-                string.append('[%s]' % roll)
-
-            elif reroll is not None:  # Handle rerolling dice without a comparison modifier (ie. on 1)
-                type_of_dice = int(reroll[3])
-
-                result_strings = []
-                roll_strings = []
-                result = roll_group(reroll[1])
-                repeat = True if reroll[4] == 'R' else False # Reroll just once or infinite number of times
-
-                if repeat: #Handle rerolling the dice and building a string of all the rerolled ones
-                    for i in range(len(result)):
-                        prev = [result[i]]
-                        while result[i] == 1:
-                            result[i] = random.randint(1, type_of_dice)
-                            prev.append(result[i])
-
-                        roll_strings.append([str(x) for x in prev])
+    :param roll: Roll in dice notation
+    :return: Result of roll, and an explanation string
+    """
+    return _roll(roll, functions, floats)[:2]
 
-                else:
-                    for i in range(len(result)):
-                        prev = [result[i]]
-                        if result[i] == 1:
-                            result[i] = random.randint(1, type_of_dice)
-                            prev.append(result[i])
 
-                        roll_strings.append([str(x) for x in prev])
+def dice_groups(roll):
+    """
+    Lists the dice groups in a roll, in the order they are rolled
 
-                results.append(sum(result))
-                for roll_string in roll_strings:
-                    roll_string.reverse()
-                    result_strings.append('%s' % roll_string[0] + ('~' if len(roll_string) > 1 else '') + '~'.join(roll_string[1:])) #Build the string
+    :param roll: Roll in dice notation
+    :return: List of dice groups, ie. ['4d6K3', '2d20'] for 4d6K3 + 2d20 + 3
+    """
+    return [group for group, position in tokenize(roll) if group not in OPERATORS and group not in DEFAULT_FUNCTIONS and
+            not LITERAL_PATTERN.match(group) and not FLOAT_PATTERN.match(group)]
 
-                roll = ','.join(result_strings)
-                string.append('[%s]' % roll)
 
-            elif specific_reroll is not None:  # Handle rerolling dice on a specific number, see reroll
-                type_of_dice = int(specific_reroll[3])
-                comparator = int(specific_reroll[5])
+def _check_node(node, functions, floats):
+    """
+    Checks that an arithmetic node can be evaluated by SimpleEval, without evaluating it
 
-                assert 0 < comparator <= type_of_dice # Ensure comparison is within bounds
+    :param node: Node to check
+    :param functions: Whether function calls are allowed
+    :param floats: Whether floats are allowed
+    :return: The offending node and the reason it is invalid, or None
+    """
+    operators = DEFAULT_OPS if floats else DEFAULT_OPS_NO_FLOAT
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return None
+    elif isinstance(node, ast.UnaryOp):
+        if type(node.op) not in operators:
+            return node, 'unary operator is not allowed'
+        return _check_node(node.operand, functions, floats)
+    elif isinstance(node, ast.BinOp):
+        if type(node.op) not in operators:
+            return node, 'operator is not allowed'
+        return _check_node(node.left, functions, floats) or _check_node(node.right, functions, floats)
+    elif isinstance(node, ast.Call):
+        if not functions:
+            return node, 'function calls are disabled'
+        if not isinstance(node.func, ast.Name) or node.func.id not in DEFAULT_FUNCTIONS:
+            return node, 'unknown function'
+        minimum, maximum = FUNCTION_ARITY.get(node.func.id, (0, None))
+        if node.keywords or len(node.args) < minimum or (maximum is not None and len(node.args) > maximum):
+            return node, 'wrong number of arguments to %s' % node.func.id
+        for arg in node.args:
+            problem = _check_node(arg, functions, floats)
+            if problem is not None:
+                return problem
+        return None
+    return node, '%s is not allowed' % type(node).__name__
+
+
+@functools.lru_cache(maxsize=1024)
+def _validate(roll, functions, floats):
+    """
+    Cached implementation of validate
 
-                result_strings = []
-                roll_strings = []
-                result = roll_group(specific_reroll[1])
-                repeat = True if specific_reroll[4] == 'R' else False
+    :return: Tuple of DiceDiagnostic
+    """
+    tokens = tokenize(roll)
+
+    diagnostics = []
+    expression = []
+    offsets = []  # Start of each token in the placeholder expression
+    length = 0
+    for group, position in tokens:
+        offsets.append(length)
+        if group in OPERATORS or group in DEFAULT_FUNCTIONS:
+            expression.append(group)
+        else:
+            try:
+                parse_group(group, floats)
+            except ValueError as e:
+                diagnostics.append(DiceDiagnostic(group, position, str(e)))
+            expression.append('1')  # Stand in for the value of the group
+        length += len(expression[-1])
 
-                if repeat:
-                    for i in range(len(result)):
-                        prev = [result[i]]
-                        while result[i] == comparator:
-                            result[i] = random.randint(1, type_of_dice)
-                            prev.append(result[i])
+    if diagnostics:
+        return tuple(diagnostics)
 
-                        roll_strings.append([str(x) for x in prev])
+    def locate(col_offset):  # Map an offset in the placeholder expression back to a token
+        index = max(i for i, offset in enumerate(offsets) if offset <= max(col_offset, 0)) if offsets else 0
+        return tokens[index] if tokens else ('', 0)
 
-                else:
-                    for i in range(len(result)):
-                        prev = [result[i]]
-                        if result[i] == comparator:
-                            result[i] = random.randint(1, type_of_dice)
-                            prev.append(result[i])
+    try:
+        body = ast.parse(''.join(expression)).body
+    except SyntaxError as e:
+        group, position = locate((e.offset or 1) - 1)
+        return DiceDiagnostic(group, position, 'invalid syntax'),
 
-                        roll_strings.append([str(x) for x in prev])
+    if len(body) != 1 or not isinstance(body[0], ast.Expr):
+        return DiceDiagnostic(roll, 0, 'roll must be a single expression'),
 
-                results.append(sum(result))
-                for roll_string in roll_strings:
-                    roll_string.reverse()
-                    result_strings.append('%s' % roll_string[0] + ('~' if len(roll_string) > 1 else '') + '~'.join(roll_string[1:]))
+    problem = _check_node(body[0].value, functions, floats)
+    if problem is not None:
+        node, reason = problem
+        group, position = locate(node.col_offset)
+        return DiceDiagnostic(group, position, reason),
+    return ()
 
-                roll = ','.join(result_strings)
-                string.append('[%s]' % roll)
 
-            elif comparison_reroll is not None:  # Handle rerolling dice with a comparison modifier.
-                type_of_dice = int(comparison_reroll[3])
-                comparator = int(comparison_reroll[6])
+def validate(roll, *, functions=True, floats=True):
+    """
+    Checks a roll in dice notation without rolling any dice
 
-                if comparison_reroll[5] == '>':  # Ensure comparison is within bounds
-                    assert 0 < comparator < type_of_dice
-                else:
-                    assert 1 < comparator <= type_of_dice
-
-                result_strings = []
-                roll_strings = []
-                result = roll_group(comparison_reroll[1])
-                repeat = True if comparison_reroll[4] == 'R' else False
-                if comparison_reroll[5] == '>':
-                    if repeat:
-                        for i in range(len(result)):
-                            prev = [result[i]]
-                            while result[i] > comparator:
-                                result[i] = random.randint(1, type_of_dice)
-                                prev.append(result[i])
-
-                            roll_strings.append([str(x) for x in prev])
-
-                    else:
-                        for i in range(len(result)):
-                            prev = [result[i]]
-                            if result[i] > comparator:
-                                result[i] = random.randint(1, type_of_dice)
-                                prev.append(result[i])
-
-                            roll_strings.append([str(x) for x in prev])
-                else:
-                    if repeat:
-                        for i in range(len(result)):
-                            prev = [result[i]]
-                            while result[i] < comparator:
-                                result[i] = random.randint(1, type_of_dice)
-                                prev.append(result[i])
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: List of DiceDiagnostic, empty if the roll is valid
+    """
+    return list(_validate(roll, functions, floats))
 
-                            roll_strings.append([str(x) for x in prev])
 
-                    else:
-                        for i in range(len(result)):
-                            prev = [result[i]]
-                            if result[i] < comparator:
-                                result[i] = random.randint(1, type_of_dice)
-                                prev.append(result[i])
+def check_roll(roll, *, functions=True, floats=True):
+    """
+    Checks a roll in dice notation without rolling any dice, raising an exception if it is invalid
 
-                            roll_strings.append([str(x) for x in prev])
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: None
+    :raises TypeError: When the roll is not a string
+    :raises ValueError: When the roll is invalid, listing every diagnostic
+    """
+    if type(roll) != str:  # Make sure dice roll is a str
+        raise TypeError('Dice roll must be a string in dice notation')
+    diagnostics = validate(roll, functions=functions, floats=floats)  # Make sure dice roll parses without rolling it
+    if diagnostics:
+        raise ValueError('Dice roll specified was not a valid diceroll.\n%s\n' % '\n'.join(str(d) for d in diagnostics))
 
-                results.append(sum(result))
-                for roll_string in roll_strings:
-                    roll_string.reverse()
-                    result_strings.append('%s' % roll_string[0] + ('~' if len(roll_string) > 1 else '') + '~'.join(roll_string[1:]))
 
-                roll = ','.join(result_strings)
-                string.append('[%s]' % roll)
+OPERATOR_SYMBOLS = {operator.add: '+', operator.sub: '-', operator.mul: '*', operator.truediv: '/',
+                    operator.floordiv: '//', operator.mod: '%', operator.neg: '-', operator.pos: '+'}
 
-            elif success_comparison is not None:
-                group_result = roll_group(success_comparison[1])
-                result = []
-                result_string = []
+TABLE_LIMIT = 65536  # Largest face table built for a compiled dice group
 
-                type_of_dice = int(success_comparison[2])
 
-                comparator = int(success_comparison[4])
+def _compiled_function(func):
+    """
+    Wraps a whitelisted function for compiled rolls, turning booleans into 0 and 1 like SimpleEval does
+    """
+    def call(*args):
+        value = func(*args)
+        return int(value) if isinstance(value, bool) else value
+    return call
 
-                if success_comparison[3] == '>':  # Ensure comparison is within bounds
-                    assert 0 < comparator < type_of_dice
-                else:
-                    assert 1 < comparator <= type_of_dice
-
-                for die in group_result:
-                    if success_comparison[3] == '>':
-                        result.append(1 if die > comparator else 0)
-                        result_string.append('!' + str(die) if die > comparator else str(die))
-                    else:
-                        result.append(1 if die < comparator else 0)
-                        result_string.append('!' + str(die) if die < comparator else str(die))
-
-                results.append(sum(result))
-                roll = ','.join(result_string)  # Craft the string, adding an exclamation mark before every string that passed the comparison.
-                string.append('[%s]' % roll)
-
-            elif success_fail_comparison is not None:
-                group_result = roll_group(success_fail_comparison[1])
-
-                result = []
-                result_string = []
-
-                type_of_dice = int(success_fail_comparison[2])
-                success_comp = int(success_fail_comparison[5])
-                fail_comp = int(success_fail_comparison[7])
-
-                # Ensure both comparisons are within bounds
-                if success_fail_comparison[4] == '>':
-                    assert 0 < success_comp < type_of_dice
-                    assert 1 < fail_comp <= type_of_dice
-                else:
-                    assert 1 < success_comp <= type_of_dice
-                    assert 0 < fail_comp < type_of_dice
-
-                for die in group_result:
-                    if success_fail_comparison[4] == '>':  # Get the actual list of successes and fails with both comparisons
-                        if die > success_comp:
-                            result.append(1)
-                            result_string.append('!' + str(die))
-                        elif die < fail_comp:
-                            result.append(-1)
-                            result_string.append('*' + str(die))
-                        else:
-                            result.append(0)
-                            result_string.append(str(die))
-                    else:
-                        if die < success_comp:
-                            result.append(1)
-                            result_string.append('!' + str(die))
-                        elif die > fail_comp:
-                            result.append(-1)
-                            result_string.append('*' + str(die))
-                        else:
-                            result.append(0)
-                            result_string.append(str(die))
-
-                results.append(sum(result))  #
-                roll = ','.join(result_string)
-                string.append('[%s]' % roll)
-
-            elif keep is not None:  # Handle rolling dice and keeping the x highest or lowest values
-                group_result = roll_group(keep[1])
-                group_result.sort(reverse=True if keep[
-                                                      2] == 'K' else False)  # Uppercase is keep highest and lowercase is keep lowest.
-
-                num_to_keep = int(keep[3] if keep[3] != '' else 1)
-                assert 1 <= num_to_keep < len(group_result)
-
-                results.append(sum(group_result[:num_to_keep]))
-                roll = ','.join([str(i) for i in group_result[
-                                                 :num_to_keep]]) + ' ~~ '  # This time format the string with all kept rolls on the left and dropped rolls on the right
-                roll += ','.join([str(i) for i in group_result[num_to_keep:]])
-                string.append('[%s]' % roll)
-
-            elif drop is not None:
-                group_result = roll_group(drop[1])
-                group_result.sort(reverse=True if drop[2] == 'X' else False)  # Same thing as keep dice
-
-                num_to_drop = int(drop[3] if drop[3] != '' else 1)
-                assert 1 <= num_to_drop < len(group_result)
-
-                results.append(sum(group_result[:num_to_drop]))
-                roll = ','.join([str(i) for i in group_result[num_to_drop:]]) + ' ~~ '  # Same as above.
-                roll += ','.join([str(i) for i in group_result[:num_to_drop]])
-                string.append('[%s]' % roll)
-
-            elif individual is not None:
-                group_result = roll_group(individual[1])
-                result = []
-                for i, j in enumerate(group_result): #add to each roll
-                    if individual[4] == 'a':
-                        result.append(j + int(individual[5]))
-
-                    elif individual[4] == 's':
-                        result.append(j - int(individual[5]))
-
-                    elif individual[4] == 'm':
-                        result.append(j * int(individual[5]))
-
-                    else:
-                        raise ValueError
-                results.append(sum(result))
-                roll = ','.join([str(x) + individual[4] + individual[5] for x in group_result]) #Create string with the modifier on each roll
-                string.append('[%s]' % roll)
-
-            elif normal is not None:
-                group_result = roll_group(group)
-                results.append(sum(group_result))
-                roll = ','.join([str(i) for i in group_result])
-                string.append('[%s]' % roll)
-
-            elif literal is not None:
-                results.append(int(literal[1]))  # Just append the integer value
-                string.append(literal[1])
-
-            elif float_literal is not None:
-                if floats:
-                    results.append(float(group))
-                    string.append(group)
-                else:
-                    raise TypeError
-            else:
-                raise Exception
 
-        except Exception:
-            raise DiceGroupException('"%s" is not a valid dicegroup.' % group)
+def _compile_group(group, name, namespace):
+    """
+    Generates the source rolling one dice group. Groups without rerolls or explosions are rolled straight from a
+    table of what each face adds to the group, anything else goes through DiceGroup.roll.
 
-    parser = SimpleEval(floats=floats, functions=functions) #The parser object parses the dice rolls and functions
+    :param group: DiceGroup
+    :param name: Name of the group in the namespace
+    :param namespace: Namespace of the compiled function, the tables of the group are added to it
+    :return: Source of an expression evaluating to the value of the group
+    """
+    die = group.die
+    if group.reroll is not None or group.explode is not None or not die._bulk or \
+            (len(die.faces) > TABLE_LIMIT and (group.individual is not None or group.success is not None)):
+        namespace[name] = group
+        return '%s.roll().value' % name
+
+    faces = die.faces
+    if group.individual is not None:
+        modifier, number = group.individual
+        faces = tuple(face + number if modifier == 'a' else (face - number if modifier == 's' else face * number)
+                      for face in faces)
+
+    def score(value):
+        if group.success_test(value):
+            return 1
+        return -1 if group.failure_test is not None and group.failure_test(value) else 0
+
+    if group.keep is None and group.success is not None:  # Roll the scores straight away
+        faces = tuple(score(value) for value in faces)
+    namespace[name] = faces
+
+    num_of_dice = group.num_of_dice
+    dice = '_choices(%s, k=%d)' % (name, num_of_dice)
+    if group.keep is not None:
+        mode, number = group.keep
+        kept = {'K': '%d:' % (num_of_dice - number), 'k': ':%d' % number,
+                'X': ':%d' % (num_of_dice - number), 'x': '%d:' % number}[mode]
+        dice = 'sorted(%s)[%s]' % (dice, kept)
+        if group.success is not None:
+            namespace[name + '_score'] = {value: score(value) for value in set(faces)}
+            dice = 'map(%s_score.__getitem__, %s)' % (name, dice)
+    elif num_of_dice == 1:
+        return '_choice(%s)' % name
+    return 'sum(%s)' % dice
+
+
+def _compile_node(node, groups, functions, floats, namespace):
+    """
+    Generates the source of an arithmetic node, with native operators. Only the operators of SimpleEval and the
+    whitelisted functions are generated, and powers still go through safe_power.
+
+    :param node: AST node of a parsed roll
+    :param groups: DiceGroups of the roll
+    :param functions: Whether function calls are allowed
+    :param floats: Whether floats are allowed
+    :param namespace: Namespace of the compiled function
+    :return: Source of the node
+    """
+    operators = DEFAULT_OPS if floats else DEFAULT_OPS_NO_FLOAT
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return repr(node.value if floats else int(node.value))
+    elif isinstance(node, ast.Name) and node.id.startswith('_g'):
+        return _compile_group(groups[int(node.id[2:])], node.id, namespace)
+    elif isinstance(node, ast.UnaryOp):
+        return '(%s%s)' % (OPERATOR_SYMBOLS[operators[type(node.op)]],
+                           _compile_node(node.operand, groups, functions, floats, namespace))
+    elif isinstance(node, ast.BinOp):
+        func = operators[type(node.op)]
+        left = _compile_node(node.left, groups, functions, floats, namespace)
+        right = _compile_node(node.right, groups, functions, floats, namespace)
+        if func is safe_power:
+            return '_safe_power(%s, %s)' % (left, right)
+        return '(%s %s %s)' % (left, OPERATOR_SYMBOLS[func], right)
+    elif isinstance(node, ast.Call) and functions and node.func.id in DEFAULT_FUNCTIONS and not node.keywords:
+        namespace['_f_' + node.func.id] = _compiled_function(DEFAULT_FUNCTIONS[node.func.id])
+        return '_f_%s(%s)' % (node.func.id, ', '.join(_compile_node(arg, groups, functions, floats, namespace)
+                                                       for arg in node.args))
+    raise ValueError('%s is not allowed' % type(node).__name__)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_roll(roll, functions, floats):
+    """
+    Cached implementation of compile_roll
+    """
+    fragments, groups, tree, locations = _parse_roll(roll, floats)
+    namespace = {'__builtins__': {}, 'sum': sum, 'sorted': sorted, 'map': map, 'int': int, 'Exception': Exception,
+                 '_choices': random.choices, '_choice': random.choice, '_safe_power': safe_power,
+                 '_DiceOperatorException': DiceOperatorException}
     try:
-        final_result = parser.eval(''.join([str(x) for x in results])) #Call the parser to parse into one value
-        if not floats:
-            final_result = int(final_result)
+        body = _compile_node(tree, groups, functions, floats, namespace)
     except Exception:
         raise DiceOperatorException('Error parsing operators and or functions')
+    if not floats:
+        body = 'int(%s)' % body
 
-    #Create explanation string and remove extraneous spaces
-    explanation = ''.join(string)
-    explanation = zero_width_split(r"""((?<=[\/%^+])(?![\/,]))| # Split between /, %, ^, and +
-                                    ((?<![\/,])(?=[\/%^+]))| # Same as above
-                                    ((?<=[^(])(?=-))(?!-[^[]*])| # Split in front of - that are not in a roll
-                                    (?<=-)(?=[^\d()a-z])| # Same for splitting after - and before non-literals
-                                    (?<=[\d)\]]-)(?=.)(?![^[]*])| # Split after a - that is not in a roll
-                                    (?<=,)(?![^[]*])| # Split after a comma that is not in a roll
-                                    (?<=([^,]\*))(?!\*)| # Split after a * that is not in a roll
-                                    (?<![,\*])(?=\*) # Split before a * that is not in a roll""", explanation) #Split on ops to properly format the explanation
-    explanation = ' '.join(explanation)
-    explanation = explanation.strip()
-    explanation = regex.sub(r'[ \t]{2,}', ' ', explanation)
+    source = ('def roll():\n'
+              '    try:\n'
+              '        return %s\n'
+              '    except Exception:\n'
+              '        raise _DiceOperatorException(\'Error parsing operators and or functions\') from None\n' % body)
+    exec(compile(source, '<roll %s>' % roll, 'exec'), namespace)
+    function = namespace['roll']
+    function.source = source
+    return function
+
+
+def compile_roll(roll, *, functions=True, floats=True):
+    """
+    Compiles a roll into a Python function, for rolling the same roll many times. The arithmetic becomes native
+    Python operators and simple dice groups become inlined calls to random.choices. Compiled functions are cached.
+
+    :param roll: Roll in dice notation
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: Function taking no arguments and returning the result of a new roll, its source is in .source
+    """
+    return _compile_roll(roll, functions, floats)
 
-    return final_result, explanation
 
 if __name__ == '__main__':
     while True:
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+"""
+Out-of-core simulation output
+
+Rolls an expression a large number of times and writes the total and the
+value of every dice group of each trial into fixed-width columns of a
+memory-mapped file. Trials are written in chunks, each seeded from the
+simulation seed and its chunk number, so a simulation can be resumed or split
+across processes writing disjoint chunks and still produce the same file.
+
+File layout, little-endian header:
+    magic, version, flags, rows, chunk size, data offset, seed, columns,
+    expression length, expression, one completion byte per chunk
+followed at the data offset by one column after the other: the totals as
+doubles, then each dice group as 64-bit integers.
+"""
+
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import sys
+from array import array
+
+from .rolldice import _roll, check_roll, dice_groups
+
+
+MAGIC = b'RDSIM\x00\x00\x01'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQqII')
+ALIGNMENT = 64
+DEFAULT_CHUNK_SIZE = 65536
+
+FLAG_FUNCTIONS = 1
+FLAG_FLOATS = 2
+FLAG_BIG_ENDIAN = 4
+
+TOTAL_FORMAT = 'd'
+GROUP_FORMAT = 'q'
+ITEM_SIZE = 8
+
+
+class Simulation:
+    def __init__(self, path, writable=False):
+        """
+        Opens an existing simulation file. Use Simulation.create to make a new one.
+
+        :param path: Path of the simulation file
+        :param writable: Whether to open for writing more chunks
+
+        Column views are zero-copy, release them before closing the simulation.
+        """
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        (magic, version, flags, self.rows, self.chunk_size, data_offset, self.seed, columns,
+         expression_length) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a simulation file' % path)
+        if bool(flags & FLAG_BIG_ENDIAN) != (sys.byteorder == 'big'):
+            self.close()
+            raise ValueError('%s was written on a machine with a different byte order' % path)
+
+        self.functions = bool(flags & FLAG_FUNCTIONS)
+        self.floats = bool(flags & FLAG_FLOATS)
+        self.roll = bytes(self._map[HEADER.size:HEADER.size + expression_length]).decode('utf-8')
+        self.groups = dice_groups(self.roll)
+        self.num_chunks = -(-self.rows // self.chunk_size)
+
+        view = memoryview(self._map)
+        chunk_map_offset = HEADER.size + expression_length
+        self._chunk_map = view[chunk_map_offset:chunk_map_offset + self.num_chunks]
+        self._columns = []
+        for column in range(columns):
+            start = data_offset + column * self.rows * ITEM_SIZE
+            self._columns.append(view[start:start + self.rows * ITEM_SIZE].cast(TOTAL_FORMAT if column == 0 else GROUP_FORMAT))
+        view.release()
+
+    @classmethod
+    def create(cls, path, roll, trials, *, seed=0, chunk_size=DEFAULT_CHUNK_SIZE, functions=True, floats=True):
+        """
+        Creates an empty simulation file, overwriting any existing file
+
+        :param path: Path of the simulation file
+        :param roll: Roll in dice notation
+        :param trials: Number of times to roll
+        :param seed: Integer seed, each chunk is seeded from it
+        :param chunk_size: Number of trials per chunk
+        :param functions: Whether to allow function calls
+        :param floats: Whether to allow floats
+        :return: Writable Simulation
+        """
+        check_roll(roll, functions=functions, floats=floats)
+        if trials < 1 or chunk_size < 1:
+            raise ValueError('Trials and chunk size must be positive')
+
+        expression = roll.encode('utf-8')
+        columns = 1 + len(dice_groups(roll))
+        num_chunks = -(-trials // chunk_size)
+        data_offset = HEADER.size + len(expression) + num_chunks
+        data_offset += -data_offset % ALIGNMENT
+
+        flags = (FLAG_FUNCTIONS if functions else 0) | (FLAG_FLOATS if floats else 0) | \
+                (FLAG_BIG_ENDIAN if sys.byteorder == 'big' else 0)
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, flags, trials, chunk_size, data_offset, seed, columns, len(expression)))
+            f.write(expression)
+            f.truncate(data_offset + columns * trials * ITEM_SIZE)  # Sparse where the filesystem allows it
+
+        return cls(path, writable=True)
+
+    @property
+    def total(self):
+        """
+        Zero-copy view of the total of every trial
+
+        :return: memoryview of doubles
+        """
+        return self._columns[0]
+
+    def group(self, index):
+        """
+        Zero-copy view of the value of one dice group in every trial
+
+        :param index: Index of the dice group, in the order of Simulation.groups
+        :return: memoryview of 64-bit integers
+        """
+        return self._columns[index + 1]
+
+    def completed(self, chunk):
+        """
+        :param chunk: Chunk number
+        :return: Whether the chunk has been written
+        """
+        return self._chunk_map[chunk] != 0
+
+    def pending_chunks(self):
+        """
+        :return: List of chunk numbers that have not been written yet
+        """
+        return [chunk for chunk in range(self.num_chunks) if not self._chunk_map[chunk]]
+
+    @property
+    def is_complete(self):
+        return not self.pending_chunks()
+
+    def write(self, chunks=None):
+        """
+        Rolls and writes chunks that have not been written yet. The global random state is restored afterwards.
+
+        :param chunks: Iterable of chunk numbers, defaults to every chunk
+        :return: Number of chunks written
+        """
+        if not self.writable:
+            raise ValueError('Simulation was not opened for writing')
+
+        written = 0
+        state = random.getstate()
+        try:
+            for chunk in (range(self.num_chunks) if chunks is None else chunks):
+                if self._chunk_map[chunk]:
+                    continue
+
+                random.seed('%d:%d' % (self.seed, chunk))
+                start = chunk * self.chunk_size
+                stop = min(start + self.chunk_size, self.rows)
+
+                columns = [array(TOTAL_FORMAT)] + [array(GROUP_FORMAT) for group in self.groups]
+                for trial in range(start, stop):
+                    total, explanation, values = _roll(self.roll, self.functions, self.floats, explain=False)
+                    columns[0].append(total)
+                    for column, value in zip(columns[1:], values):
+                        column.append(value)
+
+                for view, column in zip(self._columns, columns):
+                    view[start:stop] = column
+                self._map.flush()
+                self._chunk_map[chunk] = 1  # Only mark the chunk done once its data is on disk
+                self._map.flush()
+                written += 1
+        finally:
+            random.setstate(state)
+        return written
+
+    def close(self):
+        """
+        Closes the file. Raises BufferError while column views are still held elsewhere.
+        """
+        if self._map.closed:
+            return
+        for view in getattr(self, '_columns', []):
+            view.release()
+        if hasattr(self, '_chunk_map'):
+            self._chunk_map.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _write_chunks(path, start, stop):
+    """
+    Writes a slice of chunks, for worker processes
+
+    :return: Number of chunks written
+    """
+    with Simulation(path, writable=True) as simulation:
+        return simulation.write(range(start, stop))
+
+
+def simulate(path, roll, trials, *, seed=0, chunk_size=DEFAULT_CHUNK_SIZE, processes=1, resume=True,
+             functions=True, floats=True):
+    """
+    Runs a simulation into a memory-mapped file
+
+    :param path: Path of the simulation file
+    :param roll: Roll in dice notation
+    :param trials: Number of times to roll
+    :param seed: Integer seed
+    :param chunk_size: Number of trials per chunk
+    :param processes: Number of worker processes, each writing a disjoint slice of chunks
+    :param resume: Whether to continue an existing file for the same simulation instead of starting over
+    :param functions: Whether to allow function calls
+    :param floats: Whether to allow floats
+    :return: Number of chunks written
+    """
+    simulation = None
+    if resume and os.path.exists(path):
+        simulation = Simulation(path, writable=True)
+        if (simulation.roll, simulation.rows, simulation.seed, simulation.chunk_size, simulation.functions,
+                simulation.floats) != (roll, trials, seed, chunk_size, functions, floats):
+            simulation.close()
+            raise ValueError('%s holds a different simulation' % path)
+    if simulation is None:
+        simulation = Simulation.create(path, roll, trials, seed=seed, chunk_size=chunk_size,
+                                       functions=functions, floats=floats)
+
+    with simulation:
+        if processes <= 1:
+            return simulation.write()
+        num_chunks = simulation.num_chunks
+
+    step = -(-num_chunks // processes)
+    slices = [(path, start, min(start + step, num_chunks)) for start in range(0, num_chunks, step)]
+    with multiprocessing.Pool(processes) as pool:
+        return sum(pool.starmap(_write_chunks, slices))
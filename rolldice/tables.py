@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+"""
+Roll tables
+
+Binds a roll to ranged entries, ie. a 1d100 encounter table or a 2d6 loot
+table. Entries are indexed once when the table is made: small tables get a
+direct-address list with one slot per result, anything else a sorted list of
+boundaries searched with bisect. Entries can be tables themselves, which are
+drawn from in turn. The roll is compiled with compile_roll, so drawing does not
+parse anything. Tables check that every result the roll can have has an
+entry. Rolls with too many results to list, or without an upper bound, are
+checked against the range of the roll instead.
+"""
+
+import math
+from bisect import bisect_right
+
+from .analysis import _static, outcomes
+from .rolldice import check_roll, compile_roll
+
+
+DIRECT_LIMIT = 4096  # Largest span of results indexed with a direct-address list
+
+
+def _describe(results):
+    """
+    :return: Sorted results as text, with runs of consecutive integers joined into ranges, ie. 1-3, 5, 7.5
+    """
+    parts = []
+    start = previous = None
+    for result in results + [None]:
+        if result is not None and type(result) == int and type(previous) == int and result == previous + 1:
+            previous = result
+            continue
+        if start is not None:
+            parts.append(str(start) if start == previous else '%s-%s' % (start, previous))
+        start = previous = result
+    return ', '.join(parts)
+
+
+class RollTable:
+    def __init__(self, roll, entries, *, functions=True, floats=True):
+        """
+        Makes a table of entries for the results of a roll
+
+        :param roll: Roll in dice notation, ie. '1d100'
+        :param entries: Mapping or iterable of (key, entry) pairs. A key is a single result or an inclusive
+            (low, high) range of results. An entry is any object, or a RollTable that is drawn from in turn
+        :param functions: Whether to allow function calls
+        :param floats: Whether to allow floats
+        :raises ValueError: When ranges overlap or a result of the roll has no entry
+        """
+        check_roll(roll, functions=functions, floats=floats)
+        self.roll = roll
+        self.functions = functions
+        self.floats = floats
+        self._function = compile_roll(roll, functions=functions, floats=floats)
+
+        if hasattr(entries, 'items'):
+            entries = entries.items()
+        ranges = []
+        for key, entry in entries:
+            low, high = key if isinstance(key, tuple) else (key, key)
+            if low > high:
+                raise ValueError('Range %s-%s of a roll table is empty' % (low, high))
+            ranges.append((low, high, entry))
+        if not ranges:
+            raise ValueError('Roll table has no entries')
+        ranges.sort(key=lambda r: (r[0], r[1]))
+        for (low, high, entry), (next_low, next_high, next_entry) in zip(ranges, ranges[1:]):
+            if next_low <= high:
+                raise ValueError('Ranges %s-%s and %s-%s of a roll table overlap' % (low, high, next_low, next_high))
+
+        self._lows = [low for low, high, entry in ranges]
+        self._highs = [high for low, high, entry in ranges]
+        self._entries = [entry for low, high, entry in ranges]
+
+        self._offset = self._lows[0]
+        self._direct = None
+        span = self._highs[-1] - self._offset + 1
+        if span <= DIRECT_LIMIT and all(type(bound) == int for bound in self._lows + self._highs):
+            self._direct = [None] * span  # Index of the entry for every result, None for gaps
+            for index, (low, high) in enumerate(zip(self._lows, self._highs)):
+                self._direct[low - self._offset:high - self._offset + 1] = [index] * (high - low + 1)
+
+        results = outcomes(roll, functions=functions, floats=floats)  # None when there are too many to list
+        if results is not None:
+            missing = _describe([result for result in results if self._index(result) is None])
+        else:
+            low, high, real, risks = _static(roll, functions, floats)
+            missing = self._gaps(low, high, real)
+        if missing:
+            raise ValueError('Roll table has no entry for %s' % missing)
+
+    def _gaps(self, low, high, real):
+        """
+        Finds the parts of the range of a roll without entries. Ranges can't cover every float between them, so
+        for rolls with float results only the ends are checked.
+
+        :param low: Smallest result of the roll
+        :param high: Largest result of the roll, can be infinite
+        :param real: Whether results can be floats
+        :return: Gaps as text, ie. 1-3, 18-inf, or an empty string
+        """
+        if real:
+            gaps = []
+            if low < self._lows[0]:
+                gaps.append('results below %s' % self._lows[0])
+            if high > self._highs[-1]:
+                gaps.append('results above %s' % self._highs[-1])
+            return ', '.join(gaps)
+
+        gaps = []
+        start = low
+        for entry_low, entry_high in zip(self._lows, self._highs):
+            if entry_low > high:
+                break
+            if entry_low > start:
+                gaps.append((start, min(entry_low - 1, high)))
+            start = max(start, entry_high + 1)
+        if start <= high and start != math.inf:  # The last range can end at math.inf
+            gaps.append((start, high))
+        return ', '.join(str(a) if a == b else '%s-%s' % (a, b) for a, b in gaps)
+
+    def _index(self, result):
+        """
+        :return: Index of the entry for a result, or None if there is none
+        """
+        direct = self._direct
+        if direct is not None and type(result) == int:
+            position = result - self._offset
+            return direct[position] if 0 <= position < len(direct) else None
+        index = bisect_right(self._lows, result) - 1
+        return index if index >= 0 and result <= self._highs[index] else None
+
+    def lookup(self, result):
+        """
+        Finds the entry for a result without rolling. Nested tables are returned as they are.
+
+        :param result: Result of the roll
+        :return: Entry
+        """
+        index = self._index(result)
+        if index is None:
+            raise KeyError('Roll table has no entry for %r' % (result,))
+        return self._entries[index]
+
+    def __getitem__(self, result):
+        return self.lookup(result)
+
+    def __contains__(self, result):
+        return self._index(result) is not None
+
+    def draw(self):
+        """
+        Rolls the table, drawing from nested tables until an entry is reached
+
+        :return: Entry
+        """
+        entry = self.lookup(self._function())
+        return entry.draw() if isinstance(entry, RollTable) else entry
+
+    def __call__(self):
+        return self.draw()
+
+    def draws(self, count):
+        """
+        Rolls the table a number of times. Nested tables are drawn from in bulk as well.
+
+        :param count: Number of draws
+        :return: List of entries
+        """
+        function = self._function
+        index = self._index
+        entries = self._entries
+        results = [function() for i in range(count)]
+        drawn = [None] * count
+        nested = {}  # Positions of the draws landing on each nested table
+        for position, result in enumerate(results):
+            i = index(result)
+            if i is None:
+                raise KeyError('Roll table has no entry for %r' % (result,))
+            entry = entries[i]
+            if isinstance(entry, RollTable):
+                nested.setdefault(i, []).append(position)
+            else:
+                drawn[position] = entry
+        for i, positions in nested.items():
+            for position, entry in zip(positions, entries[i].draws(len(positions))):
+                drawn[position] = entry
+        return drawn
+
+    @property
+    def entries(self):
+        """
+        :return: List of (low, high, entry) in order of the results
+        """
+        return list(zip(self._lows, self._highs, self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return 'RollTable(%r, %d entries)' % (self.roll, len(self._entries))
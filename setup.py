@@ -15,10 +15,11 @@ setuptools.setup(
     url="https://github.com/ThePlasmaRailgun/py-rolldice",
     packages=setuptools.find_packages(),
     classifiers=(
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.8",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
         "Operating System :: OS Independent",
     ),
+    python_requires='>=3.8',
     install_requires=[
         'regex',
     ],